@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import discord
+
+import main
+from storage import asyncpg
+
+# 負荷テスト・ベンチマーク
+# Discord に接続せず、スラッシュコマンドのコールバックを偽の Interaction で直接呼び出す。
+# 一時データベースに対して N 人の同時ユーザーを走らせ、コマンドごとの処理量と遅延を計測する。
+#
+#   python bench.py --users 50 --iterations 20
+#   python bench.py --save-baseline bench_baseline.json
+#   python bench.py --baseline bench_baseline.json   # 悪化していれば終了コード 1
+#   STORAGE=memory python bench.py                   # 保存先を比べる（postgres は DATABASE_URL も）
+# .env の設定を読んでも、データは一時ディレクトリ・一時スキーマにしか書かない
+
+ADMIN_ID = 1
+STARTING_BALANCE = 10_000_000
+GACHA_ROLE_IDS = range(9000, 9010)
+ROLE_LATENCY = 0.0  # --role-latency
+
+
+class FakeResponse:
+
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        if self._done:
+            raise discord.InteractionResponded(self._interaction)
+        self._done = True
+        self._interaction.messages.append((content, kwargs))
+
+    async def defer(self, **kwargs):
+        if self._done:
+            raise discord.InteractionResponded(self._interaction)
+        self._done = True
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+        self._interaction.messages.append((None, kwargs))
+
+
+class FakeMessage:
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeFollowup:
+
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self._interaction.messages.append((content, kwargs))
+        return FakeMessage()
+
+
+class FakeRole:
+
+    def __init__(self, role_id):
+        self.id = role_id
+        self.name = f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMember:
+
+    def __init__(self, user_id, guild, admin=False):
+        self.id = user_id
+        self.guild = guild
+        self.bot = False
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.roles = []
+        self.guild_permissions = discord.Permissions(administrator=admin)
+
+    async def add_roles(self, *roles, reason=None, atomic=True):
+        # Discord のメンバー更新 API の代わり（1ロール1リクエストぶんの遅延）
+        if ROLE_LATENCY:
+            await asyncio.sleep(ROLE_LATENCY * len(roles))
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id=1):
+        self.id = guild_id
+        self.roles = {role_id: FakeRole(role_id) for role_id in GACHA_ROLE_IDS}
+        self.members = {}
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def member(self, user_id, admin=False):
+        if user_id not in self.members:
+            self.members[user_id] = FakeMember(user_id, self, admin)
+        return self.members[user_id]
+
+
+class FakeInteraction:
+
+    def __init__(self, user, guild, command):
+        self.id = time.perf_counter_ns()
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.command = command
+        self.extras = {}
+        self.messages = []
+        self.created_at = discord.utils.utcnow()
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# ベンチマークするコマンドと引数
+SCENARIOS = {
+    'balance': (main.check_balance, ()),
+    'slot': (main.slot_machine, (10, )),
+    'slot_x100': (main.slot_machine, (1, 100)),
+    'daily': (main.daily_bonus, ()),
+    'buy': (main.buy_item, (1, )),
+    'buy_limited': (main.buy_item, (2, )),
+    'gacha': (main.role_gacha, ()),
+    'gacha_x10': (main.role_gacha, (10, )),
+    'shop': (main.shop, ()),
+    'leaderboard': (main.leaderboard, ()),
+    'rank': (main.rank, ()),
+}
+
+
+async def call(command, user, guild, args):
+    interaction = FakeInteraction(user, guild, command)
+    await command.callback(interaction, *args)
+    return interaction
+
+
+# 一時データベースにショップとガチャのデータを用意する
+async def setup(guild):
+    await main.init_db()
+    admin = guild.member(ADMIN_ID, admin=True)
+
+    await call(main.add_item, admin, guild, ('Bench Item', 10, 'unlimited'))
+    await call(main.add_item, admin, guild,
+               ('Limited Item', 10, 'limited', 1000))
+    for i in range(30):
+        await call(main.add_item, admin, guild, (f'Filler {i}', 50, 'filler'))
+    for role_id in GACHA_ROLE_IDS:
+        await call(main.add_gacha_role, admin, guild,
+                   (guild.get_role(role_id), 2.5))
+
+
+def percentile(samples, q):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[q - 1]
+
+
+async def run_scenario(name, guild, users, iterations, warmup):
+    command, args = SCENARIOS[name]
+    members = [guild.member(100 + i) for i in range(users)]
+    latencies = []
+    errors = 0
+
+    # 残高不足で早く終わるコマンドが混ざらないよう、十分な残高を持たせる
+    economy = await main.economies.get(guild.id)
+    for member in members:
+        balance = await economy.get_balance(member.id)
+        if balance < STARTING_BALANCE:
+            await economy.adjust(member.id, STARTING_BALANCE - balance)
+    for _ in range(warmup):
+        await asyncio.gather(*(call(command, member, guild, args)
+                               for member in members))
+
+    async def user_loop(member):
+        nonlocal errors
+        for _ in range(iterations):
+            started = time.perf_counter()
+            try:
+                await call(command, member, guild, args)
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(member) for member in members))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'errors': errors,
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+# 基準値と比べて悪化したコマンドを返す
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {base['ops_per_sec']}/s -> {result['ops_per_sec']}/s"
+            )
+    return regressions
+
+
+# .env の本番の設定で動かさないよう、保存先を一時的なものに差し替える
+# sqlite は一時ディレクトリ（ギルドごとのファイルも）、postgres は使い捨てのスキーマ
+async def isolate_storage(workdir):
+    if main.LEDGER_SERVICE:
+        raise SystemExit("bench.py はレジャーサービスでは動きません"
+                         "（LEDGER_SERVICE を外して実行してください）")
+    if main.STORAGE == 'sqlite':
+        main.economies.db.path = os.path.join(workdir, 'bench.db')
+        if main.economies.guild_path is not None:
+            main.economies.guild_path = os.path.join(workdir,
+                                                     'bench.{guild_id}.db')
+        return None
+    if main.STORAGE == 'postgres':
+        if asyncpg is None:
+            raise SystemExit("STORAGE=postgres には asyncpg が必要です")
+        schema = f'bench_{uuid.uuid4().hex[:12]}'
+        url = main.economies.dsn
+        conn = await asyncpg.connect(url)
+        try:
+            await conn.execute(f'CREATE SCHEMA {schema}')
+        finally:
+            await conn.close()
+        # クエリ文字列の残りは asyncpg が server_settings として渡す
+        separator = '&' if '?' in url else '?'
+        main.economies.dsn = f'{url}{separator}search_path={schema}'
+        return url, schema
+    return None
+
+
+async def drop_schema(url, schema):
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+    finally:
+        await conn.close()
+
+
+async def run(options):
+    # 計測用の DB は一時ディレクトリ（postgres は一時スキーマ）に作り、終わったら消す
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        schema = await isolate_storage(workdir)
+        guild = FakeGuild()
+        # 表示名の解決は Discord に問い合わせず偽のメンバーを返す
+        main.bot.get_user = guild.get_member
+
+        results = {}
+        try:
+            await setup(guild)
+            for name in options.commands:
+                results[name] = await run_scenario(name, guild,
+                                                   options.users,
+                                                   options.iterations,
+                                                   options.warmup)
+        finally:
+            await main.role_grants.close()
+            await main.close_db()
+            if schema is not None:
+                await drop_schema(*schema)
+
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Slash command benchmark")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--commands',
+                        nargs='+',
+                        default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--role-latency',
+                        type=float,
+                        default=0.0,
+                        help="simulated seconds per role grant request")
+    options = parser.parse_args()
+
+    global ROLE_LATENCY
+    ROLE_LATENCY = options.role_latency
+
+    results = asyncio.run(run(options))
+
+    print(f"{'command':<14}{'calls':>7}{'errors':>7}{'ops/s':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in results.items():
+        print(f"{name:<14}{r['calls']:>7}{r['errors']:>7}{r['ops_per_sec']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"基準値を {options.save_baseline} に保存しました")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,1151 @@
+import asyncio
+import bisect
+import os
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+DB_PATH = 'bot_database.db'
+
+# SQLite の設定プロファイル（接続を開くたびに PRAGMA として適用する）
+# safe: SQLite の既定に近い設定 / balanced: WAL + NORMAL / fast: 耐久性より速度優先
+PRAGMA_PROFILES = {
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,  # 負の値は KiB 単位
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+PRAGMA_NAMES = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size',
+                'temp_store', 'busy_timeout')
+
+
+# 環境変数から PRAGMA 設定を作る
+# DB_PROFILE でプリセットを選び、DB_SYNCHRONOUS などで個別に上書きできる
+def pragmas_from_env(environ):
+    profile = environ.get('DB_PROFILE', 'balanced').lower()
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {profile} "
+                         f"(choose from {', '.join(PRAGMA_PROFILES)})")
+
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    for name in PRAGMA_NAMES:
+        value = environ.get(f'DB_{name.upper()}')
+        if value:
+            pragmas[name] = int(value) if value.lstrip('-').isdigit() else value
+    return pragmas
+
+
+# 共有データベース接続
+# 書き込み用の接続は1本だけ持ち、ロックで直列化する。読み込みは小さなプールから借りる。
+# 接続を使い回すことで sqlite3 のステートメントキャッシュ (cached_statements) が効く。
+class Database:
+
+    def __init__(self,
+                 path=DB_PATH,
+                 readers=4,
+                 cached_statements=256,
+                 pragmas=None,
+                 checkpoint_interval=0):
+        self.path = path
+        self.reader_count = readers
+        self.cached_statements = cached_statements
+        self.pragmas = dict(PRAGMA_PROFILES['balanced'] if pragmas is None
+                            else pragmas)
+        self.checkpoint_interval = checkpoint_interval
+        self.writer = None
+        self._readers = []
+        self._idle = None
+        self._write_lock = None
+        self._checkpoint_task = None
+        self.observer = None  # 計測用 observer(kind, seconds)
+
+    @property
+    def wal(self):
+        return str(self.pragmas.get('journal_mode', '')).upper() == 'WAL'
+
+    @property
+    def started(self):
+        return self.writer is not None
+
+    async def _connect(self, writer=False):
+        conn = await aiosqlite.connect(self.path,
+                                       cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            # ジャーナルモードはファイル単位の設定なので書き込み用接続で一度だけ
+            if name == 'journal_mode' and not writer:
+                continue
+            await conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    async def start(self):
+        if self.started:
+            return
+
+        self._write_lock = asyncio.Lock()
+        self._idle = asyncio.Queue()
+        self.writer = await self._connect(writer=True)
+        for _ in range(self.reader_count):
+            conn = await self._connect()
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+
+        if self.wal and self.checkpoint_interval > 0:
+            self._checkpoint_task = asyncio.create_task(
+                self._run_checkpoints())
+
+    # WAL を定期的にチェックポイントして肥大化を防ぐ（読み書きは止めない PASSIVE）
+    async def _run_checkpoints(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                async with self._write_lock:
+                    await self.writer.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            except Exception as e:
+                print(f"WAL チェックポイントに失敗しました: {e}")
+
+    async def close(self):
+        if not self.started:
+            return
+
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()
+            self._checkpoint_task = None
+
+        async with self._write_lock:
+            if self.wal:
+                await self.writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            for conn in self._readers:
+                await conn.close()
+            await self.writer.close()
+            self._readers = []
+            self.writer = None
+
+    # 読み込み用接続を借りる
+    @asynccontextmanager
+    async def reader(self):
+        started = time.perf_counter()
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+            if self.observer is not None:
+                self.observer('read', time.perf_counter() - started)
+
+    # 書き込みトランザクション（例外時はロールバック）
+    @asynccontextmanager
+    async def transaction(self):
+        started = time.perf_counter()
+        try:
+            async with self._write_lock:
+                try:
+                    yield self.writer
+                except BaseException:
+                    await self.writer.rollback()
+                    raise
+                await self.writer.commit()
+        finally:
+            if self.observer is not None:
+                self.observer('write', time.perf_counter() - started)
+
+    async def fetchone(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def execute(self, sql, params=()):
+        async with self.transaction() as conn:
+            cursor = await conn.execute(sql, params)
+            rowcount = cursor.rowcount
+            await cursor.close()
+            return rowcount
+
+    # 未適用のマイグレーションだけを1トランザクションで適用する
+    # 適用済みの段数は PRAGMA user_version に記録する
+    # 同じファイルを開く別プロセスと同時に起動しても二重に適用しないよう、
+    # 先に書き込みロック（BEGIN IMMEDIATE）を取ってから段数を読む
+    async def migrate(self, migrations=None):
+        migrations = MIGRATIONS if migrations is None else migrations
+
+        async with self.transaction() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            async with conn.execute('PRAGMA user_version') as cursor:
+                version = (await cursor.fetchone())[0]
+            if version >= len(migrations):
+                return version
+
+            for step in migrations[version:]:
+                await step(conn)
+            await conn.execute(f'PRAGMA user_version = {len(migrations)}')
+
+        print(f"データベースを v{version} から v{len(migrations)} に更新しました")
+        return len(migrations)
+
+
+async def _columns(conn, table):
+    async with conn.execute(f'PRAGMA table_info({table})') as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+# v1: 基本テーブル（user_version 導入前のデータベースもここで揃える）
+async def _create_tables(conn):
+    # ユーザーのお金を管理するテーブル
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_money (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER DEFAULT 1000,
+            last_daily DATE
+        )
+    ''')
+
+    # 既存テーブルにlast_dailyカラムを追加（存在しない場合）
+    if 'last_daily' not in await _columns(conn, 'user_money'):
+        await conn.execute('ALTER TABLE user_money ADD COLUMN last_daily DATE')
+
+    # ショップアイテムを管理するテーブル
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS shop_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            description TEXT,
+            stock INTEGER DEFAULT -1
+        )
+    ''')
+
+    # ガチャロールを管理するテーブル
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS gacha_roles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role_id INTEGER NOT NULL,
+            role_name TEXT NOT NULL,
+            probability REAL NOT NULL,
+            description TEXT
+        )
+    ''')
+
+    # 既存テーブルからcostカラムを削除（存在する場合）
+    if 'cost' in await _columns(conn, 'gacha_roles'):
+        await conn.execute('ALTER TABLE gacha_roles DROP COLUMN cost')
+
+
+# v2: よく使うクエリ用のインデックス
+async def _create_indexes(conn):
+    # ランキング
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_user_money_balance ON user_money (balance DESC)'
+    )
+    # /addrole・/removerole のロール検索
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_gacha_roles_role_id ON gacha_roles (role_id)'
+    )
+
+
+# v3: ギルドごとに分割（既存データは guild_id = 0 として残し、起動後に引き取る）
+async def _partition_by_guild(conn):
+    # 主キーを (guild_id, user_id) にするため作り直す
+    await conn.execute('''
+        CREATE TABLE user_money_v3 (
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            user_id INTEGER NOT NULL,
+            balance INTEGER DEFAULT 1000,
+            last_daily DATE,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''')
+    await conn.execute(
+        'INSERT INTO user_money_v3 (user_id, balance, last_daily) '
+        'SELECT user_id, balance, last_daily FROM user_money')
+    await conn.execute('DROP TABLE user_money')
+    await conn.execute('ALTER TABLE user_money_v3 RENAME TO user_money')
+
+    for table in ('shop_items', 'gacha_roles'):
+        await conn.execute(f'ALTER TABLE {table} '
+                           'ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0')
+
+    # ギルド内のランキング・商品一覧・ロール検索
+    await conn.execute('CREATE INDEX idx_user_money_guild_balance '
+                       'ON user_money (guild_id, balance DESC)')
+    await conn.execute(
+        'CREATE INDEX idx_shop_items_guild ON shop_items (guild_id, id)')
+    await conn.execute('DROP INDEX IF EXISTS idx_gacha_roles_role_id')
+    await conn.execute('CREATE INDEX idx_gacha_roles_guild_role '
+                       'ON gacha_roles (guild_id, role_id)')
+
+
+# v4: デイリーボーナスの日付を整数（date.toordinal()）で持ち、連続日数を記録する
+async def _daily_streak(conn):
+    await conn.execute('ALTER TABLE user_money ADD COLUMN daily_day INTEGER')
+    await conn.execute('ALTER TABLE user_money '
+                       'ADD COLUMN streak INTEGER NOT NULL DEFAULT 0')
+    # julianday('0001-01-01') = 1721425.5 が toordinal() の 1 にあたる
+    await conn.execute(
+        'UPDATE user_money '
+        'SET daily_day = CAST(julianday(last_daily) - 1721424.5 AS INTEGER), '
+        'streak = 1 WHERE last_daily IS NOT NULL')
+    await conn.execute('ALTER TABLE user_money DROP COLUMN last_daily')
+
+
+# v5: 定期補充する商品の補充後の在庫（NULL は補充しない）
+async def _restock_column(conn):
+    await conn.execute('ALTER TABLE shop_items ADD COLUMN restock_to INTEGER')
+
+
+# マイグレーション一覧（末尾に追加していく。既存の段は変更しないこと）
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _partition_by_guild,
+    _daily_streak,
+    _restock_column,
+]
+
+# ギルドに属していない（v3 より前の）データの guild_id
+LEGACY_GUILD = 0
+
+
+# 残高差分をまとめて書き込む UPSERT（行が無ければ初期残高＋差分で作成）
+FLUSH_BALANCE_SQL = '''
+    INSERT INTO user_money (guild_id, user_id, balance) VALUES (?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?
+'''
+
+# 条件付きの加算・減算を1文で行う（残高が ?5 以上のときだけ更新、初回は行を作成）
+# 行があるときは必ず ON CONFLICT 側に進むよう、SELECT は行の有無でも1行返す
+ADJUST_BALANCE_SQL = '''
+    INSERT INTO user_money (guild_id, user_id, balance)
+    SELECT ?1, ?2, ?3 + ?4 WHERE ?3 >= ?5 OR EXISTS (
+        SELECT 1 FROM user_money WHERE guild_id = ?1 AND user_id = ?2)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?4
+    WHERE balance >= ?5
+    RETURNING balance
+'''
+
+# 在庫の条件付き減算（-1 は無制限）
+BUY_ITEM_SQL = '''
+    UPDATE shop_items
+    SET stock = CASE WHEN stock = -1 THEN -1 ELSE stock - ?3 END
+    WHERE guild_id = ?1 AND id = ?2 AND (stock = -1 OR stock >= ?3)
+    RETURNING name, price, stock
+'''
+
+# デイリーボーナスの受け取り（?4 は今日の date.toordinal()）
+# 前回が昨日なら連続日数を伸ばし、それ以外は 1 からやり直す。
+# ボーナスは ?5 ＋ ?6 ×（連続日数 − 1、最大 ?7 日ぶん）。今日すでに受け取っていれば何も返さない。
+CLAIM_DAILY_SQL = '''
+    INSERT INTO user_money (guild_id, user_id, balance, daily_day, streak)
+    VALUES (?1, ?2, ?3 + ?5, ?4, 1)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET
+        balance = balance + ?5 + ?6 * MIN(
+            CASE WHEN daily_day = ?4 - 1 THEN streak ELSE 0 END, ?7),
+        streak = CASE WHEN daily_day = ?4 - 1 THEN streak + 1 ELSE 1 END,
+        daily_day = ?4
+    WHERE daily_day IS NULL OR daily_day < ?4
+    RETURNING balance, streak
+'''
+
+# 購入結果 status: ok / not_found / out_of_stock / insufficient
+PurchaseResult = namedtuple('PurchaseResult',
+                            'status name price stock balance')
+
+
+# 購入で残高が足りないとき、在庫の減算ごとトランザクションを取り消すために投げる（storage.py でも使う）
+class InsufficientBalance(Exception):
+    pass
+
+
+# 残高レジャー（ライトビハインド）
+# 残高の変更はメモリ上に即時反映し、差分を user_money へまとめてコミットする。
+# flush_interval 秒ごと、または未コミットの変更が max_pending 件に達した時点で書き込む。
+# max_pending はクラッシュ時に失われうる変更数の上限で、0 にすると毎回コミットする。
+# 残高は (guild_id, user_id) ごとに管理する。
+class BalanceLedger:
+
+    def __init__(self,
+                 db,
+                 default_balance=1000,
+                 flush_interval=1.0,
+                 max_pending=500):
+        self.db = db
+        self.default_balance = default_balance
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._balances = {}
+        self._pending = {}
+        self._pending_ops = 0
+        self._flush_lock = None
+        self._task = None
+        self._listeners = {}  # guild_id -> 残高変更の通知先 (user_id, balance)
+
+    async def start(self):
+        if self._task is not None:
+            return
+
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"残高のフラッシュに失敗しました: {e}")
+
+    def subscribe(self, guild_id, listener):
+        self._listeners.setdefault(guild_id, []).append(listener)
+
+    # 残高取得（未キャッシュならDBから読み込む）
+    async def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        balance = self._balances.get(key)
+        if balance is not None:
+            return balance
+
+        row = await self.db.fetchone(
+            'SELECT balance FROM user_money WHERE guild_id = ? AND user_id = ?',
+            key)
+        loaded = row[0] if row else self.default_balance
+        return self._balances.setdefault(key, loaded)
+
+    # SQL で直接加算したぶんをキャッシュに反映する（balance は加算後の DB の値）
+    def credited(self, guild_id, user_id, delta, balance):
+        key = (guild_id, user_id)
+        if key in self._balances:
+            balance = self._balances[key] + delta
+        self._balances[key] = balance
+        self._notify(guild_id, user_id, balance)
+        return balance
+
+    # 残高を SQL で直接書き換える（sql は RETURNING user_id, balance で変更後の残高を返すこと）
+    # 利息・資産税などが DB の古い残高で計算しないよう、このギルドの未コミットの差分を
+    # 同じトランザクションで先に書き込む。実行中に積まれた差分はまだ DB に無いので、
+    # キャッシュ = 変更後の DB の値 + 未コミットの差分 に揃えられる
+    async def rewrite(self, guild_id, sql, params):
+        async with self._flush_lock:
+            batch = {
+                key: self._pending.pop(key)
+                for key in [k for k in self._pending if k[0] == guild_id]
+            }
+            flushed = [(key[0], key[1], self.default_balance + delta, delta)
+                       for key, delta in batch.items()]
+            try:
+                async with self.db.transaction() as conn:
+                    if flushed:
+                        await conn.executemany(FLUSH_BALANCE_SQL, flushed)
+                    async with conn.execute(sql, params) as cursor:
+                        rows = await cursor.fetchall()
+            except BaseException:
+                for key, delta in batch.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+                raise
+
+            for user_id, balance in rows:
+                key = (guild_id, user_id)
+                balance += self._pending.get(key, 0)
+                if key in self._balances:
+                    self._balances[key] = balance
+                self._notify(guild_id, user_id, balance)
+        return rows
+
+    # キャッシュを捨てる（SQL で直接書き換えたあとに呼ぶ）
+    # 未コミットの差分があるユーザーは、キャッシュが正しいのでそのまま残す
+    def forget(self, guild_id):
+        for key in [k for k in self._balances if k[0] == guild_id]:
+            if key not in self._pending:
+                del self._balances[key]
+
+    # 残高に差分を加える（残高が required 未満なら何もせず None を返す）
+    # required を省略すると、減算のときは残高がマイナスにならないことを条件にする
+    async def adjust(self, guild_id, user_id, delta, required=None):
+        if required is None:
+            required = max(0, -delta)
+
+        if self.max_pending <= 0:
+            return await self._adjust_now(guild_id, user_id, delta, required)
+
+        # 確認から反映までの間に await を挟まないので、同じユーザーの同時実行でも上書きされない
+        key = (guild_id, user_id)
+        balance = await self.get(guild_id, user_id)
+        if balance < required:
+            return None
+
+        balance += delta
+        self._balances[key] = balance
+        self._pending[key] = self._pending.get(key, 0) + delta
+        self._pending_ops += 1
+        self._notify(guild_id, user_id, balance)
+
+        if self._pending_ops >= self.max_pending:
+            await self.flush()
+        return balance
+
+    # 複数ユーザーの残高をまとめて増減し、1トランザクションで書き込む（deltas: user_id -> 差分）
+    # 減算で残高が足りないユーザーは 0 で止める。戻り値は実際に反映した差分（user_id -> 差分）
+    # 未キャッシュの残高は chunk_size 人ずつ読み込み、そのたびに progress(読み込み済み, 総数) を呼ぶ
+    async def adjust_many(self, guild_id, deltas, progress=None, chunk_size=500):
+        missing = [
+            user_id for user_id in deltas
+            if (guild_id, user_id) not in self._balances
+        ]
+        loaded = {}
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            rows = await self.db.fetchall(
+                'SELECT user_id, balance FROM user_money WHERE guild_id = ? '
+                f'AND user_id IN ({", ".join("?" * len(chunk))})',
+                (guild_id, *chunk))
+            found = dict(rows)
+            for user_id in chunk:
+                loaded[user_id] = found.get(user_id, self.default_balance)
+            if progress is not None:
+                await progress(i + len(chunk), len(missing))
+
+        # 確認から反映までの間に await を挟まない
+        applied = {}
+        for user_id, delta in deltas.items():
+            key = (guild_id, user_id)
+            balance = self._balances.get(key)
+            if balance is None:
+                balance = loaded[user_id]
+            if balance + delta < 0:
+                delta = -balance
+
+            applied[user_id] = delta
+            balance += delta
+            self._balances[key] = balance
+            if delta:
+                self._pending[key] = self._pending.get(key, 0) + delta
+                self._pending_ops += 1
+                self._notify(guild_id, user_id, balance)
+
+        await self.flush()
+        return applied
+
+    # 即時コミットモード：1文・1往復で条件付き更新する
+    async def _adjust_now(self, guild_id, user_id, delta, required):
+        async with self.db.transaction() as conn:
+            async with conn.execute(ADJUST_BALANCE_SQL,
+                                    (guild_id, user_id, self.default_balance,
+                                     delta, required)) as cursor:
+                row = await cursor.fetchone()
+
+        if row is None:
+            return None
+
+        self._balances[guild_id, user_id] = row[0]
+        self._notify(guild_id, user_id, row[0])
+        return row[0]
+
+    # 商品購入：在庫の減算と残高の引き落としを1トランザクションで行う
+    async def purchase(self, guild_id, user_id, item_id, quantity=1):
+        key = (guild_id, user_id)
+        if self.max_pending > 0:
+            await self.get(guild_id, user_id)
+
+        debited = 0
+        try:
+            async with self.db.transaction() as conn:
+                async with conn.execute(BUY_ITEM_SQL,
+                                        (guild_id, item_id,
+                                         quantity)) as cursor:
+                    item = await cursor.fetchone()
+
+                if item is None:
+                    async with conn.execute(
+                            'SELECT name, price, stock FROM shop_items '
+                            'WHERE guild_id = ? AND id = ?',
+                        (guild_id, item_id)) as cursor:
+                        row = await cursor.fetchone()
+                    if row is None:
+                        return PurchaseResult('not_found', None, None, None,
+                                              None)
+                    return PurchaseResult('out_of_stock', *row, None)
+
+                name, price, stock = item
+                cost = price * quantity
+
+                if self.max_pending <= 0:
+                    async with conn.execute(
+                            ADJUST_BALANCE_SQL,
+                        (guild_id, user_id, self.default_balance, -cost,
+                         cost)) as cursor:
+                        row = await cursor.fetchone()
+                    if row is None:
+                        raise InsufficientBalance()
+                    balance = row[0]
+                else:
+                    # キャッシュ上で確認・反映し、差分は在庫と同じトランザクションで書く
+                    # （ロック待ちの間に forget() でキャッシュが消えていることがあるので読み直す。
+                    # ここから反映までは await を挟まない）
+                    balance = await self.get(guild_id, user_id)
+                    if balance < cost:
+                        raise InsufficientBalance()
+                    balance -= cost
+                    self._balances[key] = balance
+                    debited = cost
+                    await conn.execute(FLUSH_BALANCE_SQL,
+                                       (guild_id, user_id,
+                                        self.default_balance - cost, -cost))
+        except InsufficientBalance:
+            balance = await self.get(guild_id, user_id)
+            return PurchaseResult('insufficient', name, price, None, balance)
+        except BaseException:
+            if debited and key in self._balances:
+                self._balances[key] += debited
+            raise
+
+        self._balances[key] = balance
+        self._notify(guild_id, user_id, balance)
+        return PurchaseResult('ok', name, price, stock, balance)
+
+    def _notify(self, guild_id, user_id, balance):
+        for listener in self._listeners.get(guild_id, ()):
+            listener(user_id, balance)
+
+    # 未コミットの差分を1トランザクションで書き込む
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+
+            batch, self._pending = self._pending, {}
+            ops, self._pending_ops = self._pending_ops, 0
+            # 差し引き 0 のユーザーも書く（初めてのユーザーの行が作られず、順位表から消えないように）
+            rows = [(guild_id, user_id, self.default_balance + delta, delta)
+                    for (guild_id, user_id), delta in batch.items()]
+
+            try:
+                async with self.db.transaction() as conn:
+                    await conn.executemany(FLUSH_BALANCE_SQL, rows)
+            except BaseException:
+                # 書き込めなかった差分は次回に持ち越す
+                for key, delta in batch.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+                self._pending_ops += ops
+                raise
+
+            return len(rows)
+
+
+# ギルドごとの残高ランキング上位のキャッシュ
+# 上位 window 人ぶんを読み込み、以降はレジャーの変更通知で差分更新する。
+# entries には「残高が floor より多い全ユーザー」が入っている状態を保つ
+# （floor ちょうどの同点ユーザーは一部だけ入っていてもよい）。
+class TopBalances:
+
+    def __init__(self, ledger, guild_id, size=10, window=50):
+        self.ledger = ledger
+        self.guild_id = guild_id
+        self.size = size
+        self.window = window
+        self._entries = None
+        self._floor = 0
+        self._truncated = False
+        self._replay = None
+        self._lock = asyncio.Lock()
+        ledger.subscribe(guild_id, self._on_change)
+
+    def invalidate(self):
+        self._entries = None
+
+    async def _load(self):
+        # 読み込み中の変更は記録しておき、読み込み後に適用する
+        self._entries = None
+        self._replay = []
+
+        # 未コミットの差分を反映してから読む
+        await self.ledger.flush()
+        rows = await self.ledger.db.fetchall(
+            'SELECT user_id, balance FROM user_money '
+            'WHERE guild_id = ? AND balance > 0 '
+            'ORDER BY balance DESC LIMIT ?', (self.guild_id, self.window))
+
+        self._truncated = len(rows) >= self.window
+        self._floor = rows[-1][1] if self._truncated else 0
+        self._entries = dict(rows)
+
+        replay, self._replay = self._replay, None
+        for user_id, balance in replay:
+            self._on_change(user_id, balance)
+
+    def _on_change(self, user_id, balance):
+        if self._entries is None:
+            if self._replay is not None:
+                self._replay.append((user_id, balance))
+            return
+
+        if balance <= 0 or balance < self._floor:
+            self._entries.pop(user_id, None)
+            return
+
+        self._entries[user_id] = balance
+        if len(self._entries) > self.window * 2:
+            # 増えすぎたら上位 window 人まで切り詰める
+            kept = sorted(self._entries.items(),
+                          key=lambda entry: entry[1],
+                          reverse=True)[:self.window]
+            self._floor = kept[-1][1]
+            self._truncated = True
+            self._entries = dict(kept)
+
+    async def top(self):
+        async with self._lock:
+            if self._entries is None or (self._truncated
+                                         and len(self._entries) < self.size):
+                await self._load()
+
+        ranked = sorted(self._entries.items(),
+                        key=lambda entry: entry[1],
+                        reverse=True)
+        return ranked[:self.size]
+
+
+# RankIndex.around の結果（above / below は (user_id, balance) か None）
+RankResult = namedtuple('RankResult', 'rank total balance above below')
+
+
+# ギルド内の全ユーザーの残高順位（順序統計のための分割ソート済みリスト）
+# キー (-balance, user_id) を最大 load*2 件ずつのソート済みリストに分けて持ち、
+# 各リストの件数をフェニック木で数えるので、更新・順位の取得とも O(log n)。
+# 初回の /rank でギルドの全行を読み込み、以降はレジャーの変更通知で差分更新する。
+class RankIndex:
+
+    def __init__(self, ledger, guild_id, load=500):
+        self.ledger = ledger
+        self.guild_id = guild_id
+        self.load = load
+        self._balances = None  # user_id -> balance
+        self._lists = []
+        self._maxes = []  # 各リストの最後のキー
+        self._tree = []  # 各リストの件数のフェニック木
+        self._replay = None
+        self._lock = asyncio.Lock()
+        ledger.subscribe(guild_id, self._on_change)
+
+    def __len__(self):
+        return len(self._balances or ())
+
+    def invalidate(self):
+        self._balances = None
+
+    async def _load(self):
+        # 読み込み中の変更は記録しておき、読み込み後に適用する
+        self._balances = None
+        self._replay = []
+
+        await self.ledger.flush()
+        rows = await self.ledger.db.fetchall(
+            'SELECT user_id, balance FROM user_money WHERE guild_id = ?',
+            (self.guild_id, ))
+
+        keys = sorted((-balance, user_id) for user_id, balance in rows)
+        self._lists = [
+            keys[i:i + self.load] for i in range(0, len(keys), self.load)
+        ]
+        self._maxes = [chunk[-1] for chunk in self._lists]
+        self._build_tree()
+        self._balances = dict(rows)
+
+        replay, self._replay = self._replay, None
+        for user_id, balance in replay:
+            self._on_change(user_id, balance)
+
+    def _build_tree(self):
+        tree = [len(chunk) for chunk in self._lists]
+        for i in range(len(tree)):
+            j = i | (i + 1)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i |= i + 1
+
+    # 先頭から i 個のリストに入っている件数
+    def _count_before(self, i):
+        total = 0
+        i -= 1
+        while i >= 0:
+            total += self._tree[i]
+            i = (i & (i + 1)) - 1
+        return total
+
+    def _insert(self, key):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._build_tree()
+            return
+
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        chunk = self._lists[i]
+        bisect.insort(chunk, key)
+        self._maxes[i] = chunk[-1]
+
+        if len(chunk) > self.load * 2:
+            self._lists[i:i + 1] = [chunk[:self.load], chunk[self.load:]]
+            self._maxes[i:i + 1] = [self._lists[i][-1], chunk[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        chunk = self._lists[i]
+        del chunk[bisect.bisect_left(chunk, key)]
+
+        if not chunk:
+            del self._lists[i]
+            del self._maxes[i]
+            self._build_tree()
+        else:
+            self._maxes[i] = chunk[-1]
+            self._tree_add(i, -1)
+
+    def _on_change(self, user_id, balance):
+        if self._balances is None:
+            if self._replay is not None:
+                self._replay.append((user_id, balance))
+            return
+
+        old = self._balances.get(user_id)
+        if old == balance:
+            return
+        if old is not None:
+            self._remove((-old, user_id))
+        self._insert((-balance, user_id))
+        self._balances[user_id] = balance
+
+    # ユーザーの順位（同額は同順位）と、すぐ上・すぐ下のユーザー
+    # まだ行の無いユーザーは、残高 balance で加わったときの順位を返す
+    async def around(self, user_id, balance):
+        async with self._lock:
+            if self._balances is None:
+                await self._load()
+
+        total = len(self._balances)
+        if user_id not in self._balances:
+            total += 1
+
+        # 自分より残高が多いユーザーの数（(-balance,) は同額のどのキーよりも前）
+        i = bisect.bisect_left(self._maxes, (-balance, ))
+        if i < len(self._lists):
+            higher = self._count_before(i) + bisect.bisect_left(
+                self._lists[i], (-balance, ))
+        else:
+            higher = self._count_before(i)
+
+        # 並び順で前後のユーザー
+        key = (-balance, user_id)
+        i = bisect.bisect_left(self._maxes, key)
+        above = below = None
+        if i < len(self._lists):
+            chunk = self._lists[i]
+            j = bisect.bisect_left(chunk, key)
+            if j > 0:
+                above = chunk[j - 1]
+            elif i > 0:
+                above = self._lists[i - 1][-1]
+            j += 1 if j < len(chunk) and chunk[j] == key else 0
+            if j < len(chunk):
+                below = chunk[j]
+            elif i + 1 < len(self._lists):
+                below = self._lists[i + 1][0]
+        elif self._lists:
+            above = self._lists[-1][-1]
+
+        return RankResult(higher + 1, total, balance,
+                          (above[1], -above[0]) if above else None,
+                          (below[1], -below[0]) if below else None)
+
+
+# 1ギルドぶんの経済（データベース・レジャーと、ギルド単位のキャッシュ）
+class GuildEconomy:
+
+    def __init__(self, guild_id, db, ledger):
+        self.guild_id = guild_id
+        self.db = db
+        self.ledger = ledger
+        self.top_balances = TopBalances(ledger, guild_id, size=10)
+        self.ranks = RankIndex(ledger, guild_id)  # /rank を使うまでは空
+        self.gacha_sampler = None  # ロールの追加・削除時に作り直す
+        self.shop_pages = None  # 商品の変更時に作り直す
+
+    async def get_balance(self, user_id):
+        return await self.ledger.get(self.guild_id, user_id)
+
+    async def adjust(self, user_id, delta, required=None):
+        return await self.ledger.adjust(self.guild_id, user_id, delta,
+                                        required)
+
+    async def adjust_many(self, deltas, progress=None):
+        return await self.ledger.adjust_many(self.guild_id, deltas, progress)
+
+    async def purchase(self, user_id, item_id, quantity=1):
+        return await self.ledger.purchase(self.guild_id, user_id, item_id,
+                                          quantity)
+
+    async def rank(self, user_id):
+        balance = await self.get_balance(user_id)
+        return await self.ranks.around(user_id, balance)
+
+    # デイリーボーナスを1文で受け取る（今日受け取り済みなら None）
+    # 戻り値は (新しい残高, ボーナス額, 連続日数)
+    async def claim_daily(self, user_id, day, amount, streak_bonus, streak_max):
+        # 読み込み中の加算を二重に数えないよう、先に残高をキャッシュしておく
+        await self.get_balance(user_id)
+        async with self.db.transaction() as conn:
+            async with conn.execute(
+                    CLAIM_DAILY_SQL,
+                (self.guild_id, user_id, self.ledger.default_balance, day,
+                 amount, streak_bonus, streak_max)) as cursor:
+                row = await cursor.fetchone()
+
+        if row is None:
+            return None
+
+        balance, streak = row
+        bonus = amount + streak_bonus * min(streak - 1, streak_max)
+        balance = self.ledger.credited(self.guild_id, user_id, bonus, balance)
+        return balance, bonus, streak
+
+    # ショップの商品 (id, name, price, description, stock) を ID 順に
+    async def list_items(self):
+        return await self.db.fetchall(
+            'SELECT id, name, price, description, stock FROM shop_items '
+            'WHERE guild_id = ? ORDER BY id', (self.guild_id, ))
+
+    async def add_item(self, name, price, description, stock=-1,
+                       restock_to=None):
+        await self.db.execute(
+            'INSERT INTO shop_items (guild_id, name, price, description, '
+            'stock, restock_to) VALUES (?, ?, ?, ?, ?, ?)',
+            (self.guild_id, name, price, description, stock, restock_to))
+        self.shop_pages = None
+
+    # 商品を削除して名前を返す（無ければ None）
+    async def remove_item(self, item_id):
+        name = await self._write_one(
+            'DELETE FROM shop_items WHERE guild_id = ? AND id = ? '
+            'RETURNING name', (self.guild_id, item_id))
+        self.shop_pages = None
+        return name
+
+    # ガチャのロール (role_id, role_name, probability, description) を追加順に
+    async def list_gacha_roles(self):
+        return await self.db.fetchall(
+            'SELECT role_id, role_name, probability, description '
+            'FROM gacha_roles WHERE guild_id = ? ORDER BY id',
+            (self.guild_id, ))
+
+    # ロールを追加する（すでにあれば False）
+    async def add_gacha_role(self, role_id, role_name, probability,
+                             description):
+        added = await self.db.execute(
+            'INSERT INTO gacha_roles (guild_id, role_id, role_name, '
+            'probability, description) SELECT ?1, ?2, ?3, ?4, ?5 '
+            'WHERE NOT EXISTS (SELECT 1 FROM gacha_roles '
+            'WHERE guild_id = ?1 AND role_id = ?2)',
+            (self.guild_id, role_id, role_name, probability, description))
+        self.gacha_sampler = None
+        return added > 0
+
+    # ロールを削除して名前を返す（無ければ None）
+    async def remove_gacha_role(self, role_id):
+        name = await self._write_one(
+            'DELETE FROM gacha_roles WHERE guild_id = ? AND role_id = ? '
+            'RETURNING role_name', (self.guild_id, role_id))
+        self.gacha_sampler = None
+        return name
+
+    async def _write_one(self, sql, params):
+        async with self.db.transaction() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+        return rows[0][0] if rows else None
+
+    # SQL で直接データを書き換えたあとにキャッシュを捨てる
+    def invalidate(self):
+        self.ledger.forget(self.guild_id)
+        self.top_balances.invalidate()
+        self.ranks.invalidate()
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+
+# ギルドごとの経済の一覧
+# 既定では全ギルドが共有データベースのテーブルを guild_id で分けて使う。
+# guild_path（例: 'bot_database.{guild_id}.db'）を指定すると、ギルドごとに別の
+# SQLite ファイル・書き込みロック・レジャーを持つ。新しく作るファイルには、
+# 共有データベースにあるそのギルドの行を取り込む（共有側の行はそのまま残す）。
+class EconomyRegistry:
+
+    def __init__(self, db, ledger, guild_path=None, guild_readers=1):
+        self.db = db
+        self.ledger = ledger
+        self.guild_path = guild_path
+        self.guild_readers = guild_readers
+        self._economies = {}
+        self._lock = asyncio.Lock()
+
+    def __iter__(self):
+        return iter(self._economies.values())
+
+    # 共有データベースを開いて最新のスキーマにする
+    async def start(self):
+        await self.db.start()
+        await self.db.migrate()
+        await self.ledger.start()
+
+    async def get(self, guild_id):
+        economy = self._economies.get(guild_id)
+        if economy is not None:
+            return economy
+
+        if self.guild_path is None:
+            return self._economies.setdefault(
+                guild_id, GuildEconomy(guild_id, self.db, self.ledger))
+
+        async with self._lock:
+            if guild_id not in self._economies:
+                self._economies[guild_id] = await self._open(guild_id)
+        return self._economies[guild_id]
+
+    async def _open(self, guild_id):
+        path = self.guild_path.format(guild_id=guild_id)
+        db = Database(path,
+                      readers=self.guild_readers,
+                      cached_statements=self.db.cached_statements,
+                      pragmas=self.db.pragmas,
+                      checkpoint_interval=self.db.checkpoint_interval)
+        db.observer = self.db.observer
+        created = not os.path.exists(path)
+        await db.start()
+        try:
+            await db.migrate()
+            if created:
+                await self._import(db, guild_id)
+            ledger = BalanceLedger(db,
+                                   default_balance=self.ledger.default_balance,
+                                   flush_interval=self.ledger.flush_interval,
+                                   max_pending=self.ledger.max_pending)
+            await ledger.start()
+        except BaseException:
+            await db.close()
+            if created:
+                os.remove(path)
+            raise
+
+        return GuildEconomy(guild_id, db, ledger)
+
+    # 共有データベースからギルドの行をコピーする
+    async def _import(self, db, guild_id):
+        await self.ledger.flush()
+        async with db.transaction() as conn:
+            await conn.execute('ATTACH DATABASE ? AS shared', (self.db.path, ))
+            try:
+                for table, columns in (
+                    ('user_money',
+                     'guild_id, user_id, balance, daily_day, streak'),
+                    ('shop_items', 'id, guild_id, name, price, description, '
+                     'stock, restock_to'),
+                    ('gacha_roles', 'id, guild_id, role_id, role_name, '
+                     'probability, description'),
+                ):
+                    await conn.execute(
+                        f'INSERT INTO {table} ({columns}) '
+                        f'SELECT {columns} FROM shared.{table} WHERE guild_id = ?',
+                        (guild_id, ))
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+            finally:
+                await conn.execute('DETACH DATABASE shared')
+
+    async def close(self):
+        for economy in self._economies.values():
+            if economy.ledger is not self.ledger:
+                await economy.ledger.close()
+                await economy.db.close()
+        self._economies = {}
+        await self.ledger.close()
+        await self.db.close()
+
+
+LEGACY_COUNT_SQL = (
+    'SELECT (SELECT COUNT(*) FROM user_money WHERE guild_id = ?1) + '
+    '(SELECT COUNT(*) FROM shop_items WHERE guild_id = ?1) + '
+    '(SELECT COUNT(*) FROM gacha_roles WHERE guild_id = ?1)')
+
+
+# v3 より前のデータ（guild_id = 0）をギルドに割り当てる
+# ガチャロールはロールを持っているギルドへ。残りは guild_id のギルドへ移す
+# （guild_id が None なら移さない）。すでに同じユーザーの行があるギルドには上書きしない。
+# 戻り値は (移した行数, 残った行数)。移すものが無ければ書き込みトランザクションを開かない
+async def adopt_legacy_rows(db, role_guilds, guild_id=None):
+    row = await db.fetchone(LEGACY_COUNT_SQL, (LEGACY_GUILD, ))
+    if not row[0]:
+        return 0, 0
+
+    moved = 0
+    async with db.transaction() as conn:
+        for role_id, owner in role_guilds.items():
+            cursor = await conn.execute(
+                'UPDATE gacha_roles SET guild_id = ? '
+                'WHERE guild_id = ? AND role_id = ?',
+                (owner, LEGACY_GUILD, role_id))
+            moved += cursor.rowcount
+
+        if guild_id is not None:
+            for table in ('user_money', 'shop_items', 'gacha_roles'):
+                cursor = await conn.execute(
+                    f'UPDATE OR IGNORE {table} SET guild_id = ? WHERE guild_id = ?',
+                    (guild_id, LEGACY_GUILD))
+                moved += cursor.rowcount
+
+        async with conn.execute(LEGACY_COUNT_SQL,
+                                (LEGACY_GUILD, )) as cursor:
+            return moved, (await cursor.fetchone())[0]
@@ -0,0 +1,125 @@
+import random
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ純Pythonで抽選する
+    np = None
+
+# まとめて抽選するときの乱数生成器
+_rng = np.random.default_rng() if np is not None else None
+
+
+# ガチャの抽選器（Walker/Vose のエイリアス法）
+# 各ロールの確率（%）と「ハズレ」を1つの表にまとめておき、1回の抽選を O(1) で行う。
+# 確率の合計が100%を超える場合は、従来どおり登録順に累積して100%で打ち切る。
+class AliasSampler:
+
+    def __init__(self, items, probabilities):
+        weights = []
+        total = 0.0
+        for probability in probabilities:
+            weight = max(0.0, min(total + probability, 100.0) - total)
+            weights.append(weight)
+            total += weight
+
+        self.items = list(items)
+        self.miss_chance = 100.0 - total
+        self._prob, self._alias = self._build(weights + [self.miss_chance])
+        if np is not None:
+            self._prob_array = np.array(self._prob)
+            self._alias_array = np.array(self._alias)
+
+    @staticmethod
+    def _build(weights):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+        return prob, alias
+
+    # 1回抽選する（ハズレなら None）
+    def draw(self, rng=random):
+        i = int(rng.random() * len(self._prob))
+        if rng.random() >= self._prob[i]:
+            i = self._alias[i]
+        return self.items[i] if i < len(self.items) else None
+
+    # まとめて抽選し、インデックスの配列を返す（len(items) はハズレ）
+    def draw_indices(self, count, rng=None):
+        if rng is None:
+            rng = _rng
+        n = len(self._prob)
+        i = rng.integers(0, n, size=count)
+        keep = rng.random(count) < self._prob_array[i]
+        return np.where(keep, i, self._alias_array[i])
+
+    # count 回まとめて抽選する（ハズレは None）
+    def draw_many(self, count):
+        if np is None:
+            return [self.draw() for _ in range(count)]
+
+        return [
+            self.items[i] if i < len(self.items) else None
+            for i in self.draw_indices(count).tolist()
+        ]
+
+
+# スロットのシンボルと配当表（倍率）
+SLOT_SYMBOLS = ['🍒', '🍋', '🍊', '🍇', '🍎', '💎', '⭐', '7️⃣']
+SLOT_TRIPLE_PAYOUTS = {'💎': 10, '7️⃣': 15, '⭐': 8}  # Others are 5x
+SLOT_TRIPLE_DEFAULT = 5
+SLOT_PAIR_PAYOUT = 2  # Two matches
+SLOT_JACKPOT = 10  # 10x 以上はジャックポット
+
+_triple_table = [
+    SLOT_TRIPLE_PAYOUTS.get(symbol, SLOT_TRIPLE_DEFAULT)
+    for symbol in SLOT_SYMBOLS
+]
+if np is not None:
+    _triple_array = np.array(_triple_table)
+
+
+# 1回ぶんのリール（シンボル番号3つ）の倍率
+def slot_multiplier(reel):
+    a, b, c = reel
+    if a == b == c:
+        return _triple_table[a]
+    if a == b or b == c or a == c:
+        return SLOT_PAIR_PAYOUT
+    return 0
+
+
+# (n, 3) のリール配列の倍率をまとめて計算する
+# triple・pair を渡すと配当表を差し替えて計算できる（simulate.py での調整用）
+def slot_multipliers(reels, triple=None, pair=SLOT_PAIR_PAYOUT):
+    if triple is None:
+        triple = _triple_array
+    a, b, c = reels[:, 0], reels[:, 1], reels[:, 2]
+    is_triple = (a == b) & (b == c)
+    is_pair = (a == b) | (b == c) | (a == c)
+    return np.where(is_triple, triple[a], np.where(is_pair, pair, 0))
+
+
+# count 回ぶんのリールと倍率を生成する
+def spin_slots(count, rng=None):
+    if np is None:
+        reels = [[random.randrange(len(SLOT_SYMBOLS)) for _ in range(3)]
+                 for _ in range(count)]
+        return reels, [slot_multiplier(reel) for reel in reels]
+
+    if rng is None:
+        rng = _rng
+    reels = rng.integers(0, len(SLOT_SYMBOLS), size=(count, 3))
+    return reels.tolist(), slot_multipliers(reels).tolist()
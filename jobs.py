@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import time
+
+from discord.ext import tasks
+
+# 定期的な経済ジョブ（利息・富裕税・放置ユーザーの減衰・在庫の補充）
+# 各ジョブは user_money / shop_items に対する1本の UPDATE で、ユーザーは chunk_size 人ずつ
+# 別々のトランザクションで処理する。書き込みロックを長く持たないので /slot や /buy を止めない。
+
+# 残高ジョブ: 名前 -> (新しい残高の式, 対象の条件)
+# 式・条件では :rate などのジョブごとのパラメータと :today（date.toordinal()）が使える
+BALANCE_JOBS = {
+    # 利息（1回あたり最大 :cap）
+    'interest': ('balance + MIN(CAST(balance * :rate AS INTEGER), :cap)',
+                 'balance > 0'),
+    # 富裕税（:threshold を超えたぶんに課税）
+    'wealth_tax':
+    ('balance - CAST((balance - :threshold) * :rate AS INTEGER)',
+     'balance > :threshold'),
+    # :days 日以上 /daily を受け取っていないユーザーの残高を :floor に向けて減らす
+    'decay': ('balance - CAST((balance - :floor) * :rate AS INTEGER)',
+              'balance > :floor AND '
+              '(daily_day IS NULL OR daily_day <= :today - :days)'),
+}
+
+BALANCE_JOB_SQL = '''
+    UPDATE user_money SET balance = {expression}
+    WHERE guild_id = :guild_id AND user_id IN (
+        SELECT user_id FROM user_money
+        WHERE guild_id = :guild_id AND user_id > :after AND ({condition})
+        ORDER BY user_id LIMIT :limit)
+    RETURNING user_id, balance
+'''
+
+# 補充する商品（restock_to が設定された在庫限定の商品）を restock_to まで戻す
+RESTOCK_SQL = '''
+    UPDATE shop_items SET stock = restock_to
+    WHERE guild_id = ? AND restock_to IS NOT NULL
+      AND stock != -1 AND stock < restock_to
+    RETURNING id
+'''
+
+
+# 環境変数からジョブの設定を作る（率が 0 のジョブは動かさない）
+def jobs_from_env(environ):
+    jobs = {}
+    rate = float(environ.get('INTEREST_RATE', '0'))
+    if rate:
+        jobs['interest'] = {
+            'rate': rate,
+            'cap': int(environ.get('INTEREST_CAP', '1000000')),
+        }
+    rate = float(environ.get('WEALTH_TAX_RATE', '0'))
+    if rate:
+        jobs['wealth_tax'] = {
+            'rate': rate,
+            'threshold': int(environ.get('WEALTH_TAX_THRESHOLD', '1000000')),
+        }
+    rate = float(environ.get('DECAY_RATE', '0'))
+    if rate:
+        jobs['decay'] = {
+            'rate': rate,
+            'days': int(environ.get('DECAY_INACTIVE_DAYS', '7')),
+            'floor': int(environ.get('DECAY_FLOOR', '1000')),
+        }
+    return jobs
+
+
+class EconomyJobs:
+
+    def __init__(self,
+                 economies,
+                 guild_ids,
+                 jobs,
+                 run_at=datetime.time(0, 0, tzinfo=datetime.timezone.utc),
+                 restock_hours=0.0,
+                 chunk_size=1000,
+                 pause=0.0,
+                 before=None,
+                 on_restock=None):
+        self.economies = economies
+        self.guild_ids = guild_ids  # 対象サーバーの ID 一覧を返す関数
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.pause = pause  # チャンクの間に空ける秒数
+        self.on_restock = on_restock  # 補充したギルドごとに on_restock(guild_id) を呼ぶ
+        self.daily = tasks.loop(time=run_at)(self.run_daily)
+        self.restock = (tasks.loop(hours=restock_hours)(self.run_restock)
+                        if restock_hours > 0 else None)
+        # 最初の実行の前に待つコルーチン（bot.wait_until_ready など）
+        if before is not None:
+            self.daily.before_loop(before)
+            if self.restock is not None:
+                self.restock.before_loop(before)
+
+    def start(self):
+        if self.jobs:
+            self.daily.start()
+        if self.restock is not None:
+            self.restock.start()
+
+    def stop(self):
+        self.daily.cancel()
+        if self.restock is not None:
+            self.restock.cancel()
+
+    async def run_daily(self):
+        for name, params in self.jobs.items():
+            try:
+                await self.run_balance_job(name, params)
+            except Exception as e:
+                print(f"ジョブ {name} に失敗しました: {e}")
+
+    async def run_balance_job(self, name, params):
+        expression, condition = BALANCE_JOBS[name]
+        sql = BALANCE_JOB_SQL.format(expression=expression,
+                                     condition=condition)
+        today = datetime.date.today().toordinal()
+        started = time.perf_counter()
+        updated = 0
+
+        for guild_id in self.guild_ids():
+            economy = await self.economies.get(guild_id)
+            after = -1
+            while True:
+                rows = await economy.ledger.rewrite(
+                    guild_id, sql, {
+                        **params, 'guild_id': guild_id,
+                        'after': after,
+                        'limit': self.chunk_size,
+                        'today': today,
+                    })
+                updated += len(rows)
+                if len(rows) < self.chunk_size:
+                    break
+                after = max(user_id for user_id, _ in rows)
+                await asyncio.sleep(self.pause)
+
+        print(f"ジョブ {name}: {updated} 人の残高を更新しました"
+              f"（{time.perf_counter() - started:.2f}秒）")
+        return updated
+
+    async def run_restock(self):
+        restocked = 0
+        for guild_id in self.guild_ids():
+            economy = await self.economies.get(guild_id)
+            try:
+                async with economy.db.transaction() as conn:
+                    async with conn.execute(RESTOCK_SQL,
+                                            (guild_id, )) as cursor:
+                        rows = await cursor.fetchall()
+            except Exception as e:
+                print(f"在庫の補充に失敗しました: {e}")
+                continue
+            if rows:
+                economy.shop_pages = None
+                restocked += len(rows)
+                if self.on_restock is not None:
+                    self.on_restock(guild_id)
+
+        if restocked:
+            print(f"{restocked} 個の商品の在庫を補充しました")
+        return restocked
@@ -0,0 +1,451 @@
+import asyncio
+import json
+import os
+import signal
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from database import (EconomyRegistry, PurchaseResult, RankResult,
+                      adopt_legacy_rows)
+from jobs import EconomyJobs, jobs_from_env
+from metrics import Metrics
+from storage import storage_from_env
+
+# レジャーサービス（複数のシャードプロセスで1つのデータベースを使うため）
+# サービスが bot_database.db・レジャー・定期ジョブを持ち、各シャードは LEDGER_SERVICE
+# （unix:/path/to/ledger.sock か host:port）に接続して残高・在庫の操作を依頼する。
+# 1行が1つの JSON 配列で、同じイベントループの周回で溜まった呼び出し・応答は1行にまとめて送る。
+#   呼び出し: [id, guild_id, method, args]
+#   応答:     [id, true, 結果] / [id, false, エラーメッセージ]
+#   通知:     [0, "invalidate", guild_id]（サービス側でキャッシュが古くなったとき）
+# ギルドは1つのシャードにしか属さないので、商品・ガチャの表示キャッシュは各シャードに持たせたままでよい。
+#
+#   python ledger_service.py           # サービス
+#   SHARD_COUNT=4 SHARD_IDS=0-1 LEDGER_SERVICE=unix:ledger.sock python main.py
+
+LINE_LIMIT = 16 * 1024 * 1024  # 1行の上限（/bulkmoney のまとめた呼び出しが入る大きさ）
+
+
+class LedgerServiceError(Exception):
+    pass
+
+
+# unix:/path か host:port
+def parse_address(address):
+    if address.startswith('unix:'):
+        return address[len('unix:'):], None
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+# 送る行をイベントループの1周ぶん溜めてから書く
+class _Batcher:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._messages = []
+
+    def send(self, message):
+        if not self._messages:
+            asyncio.get_running_loop().call_soon(self._write)
+        self._messages.append(message)
+
+    def _write(self):
+        messages, self._messages = self._messages, []
+        if self.writer.is_closing():
+            return
+        self.writer.write(
+            json.dumps(messages, separators=(',', ':')).encode() + b'\n')
+
+
+async def _read_lines(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield json.loads(line)
+
+
+class LedgerService:
+
+    def __init__(self, economies):
+        self.economies = economies
+        self.guild_ids = set()  # シャードから届いたギルド（定期ジョブの対象）
+        self._clients = set()
+        self._server = None
+
+    async def start(self, address):
+        path, port = parse_address(address)
+        if port is None:
+            if os.path.exists(path):
+                os.remove(path)
+            self._server = await asyncio.start_unix_server(self._handle,
+                                                           path,
+                                                           limit=LINE_LIMIT)
+        else:
+            self._server = await asyncio.start_server(self._handle,
+                                                      path,
+                                                      port,
+                                                      limit=LINE_LIMIT)
+        print(f"レジャーサービスを {address} で起動しました")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for batcher in list(self._clients):
+                batcher.writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # サービス側でキャッシュを捨てたことを全シャードに知らせる
+    def invalidate(self, guild_id):
+        for batcher in self._clients:
+            batcher.send([0, 'invalidate', guild_id])
+
+    async def _handle(self, reader, writer):
+        batcher = _Batcher(writer)
+        self._clients.add(batcher)
+        tasks = set()
+        try:
+            async for calls in _read_lines(reader):
+                for call in calls:
+                    task = asyncio.create_task(self._call(batcher, *call))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            print(f"シャードとの接続を閉じました: {e}")
+        finally:
+            self._clients.discard(batcher)
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    async def _call(self, batcher, call_id, guild_id, method, args):
+        try:
+            handler = getattr(self, f'_rpc_{method}', None)
+            if handler is None:
+                raise LedgerServiceError(f"unknown method: {method}")
+            result = await handler(guild_id, *args)
+        except Exception as e:
+            batcher.send([call_id, False, f'{type(e).__name__}: {e}'])
+        else:
+            batcher.send([call_id, True, result])
+
+    async def _rpc_guilds(self, guild_id, guild_ids):
+        self.guild_ids.update(guild_ids)
+
+    async def _rpc_get_balance(self, guild_id, user_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.get_balance(user_id)
+
+    async def _rpc_adjust(self, guild_id, user_id, delta, required):
+        economy = await self.economies.get(guild_id)
+        return await economy.adjust(user_id, delta, required)
+
+    async def _rpc_adjust_many(self, guild_id, deltas):
+        economy = await self.economies.get(guild_id)
+        applied = await economy.adjust_many(dict(deltas))
+        return list(applied.items())
+
+    async def _rpc_purchase(self, guild_id, user_id, item_id, quantity):
+        economy = await self.economies.get(guild_id)
+        return await economy.purchase(user_id, item_id, quantity)
+
+    async def _rpc_claim_daily(self, guild_id, *args):
+        economy = await self.economies.get(guild_id)
+        return await economy.claim_daily(*args)
+
+    async def _rpc_rank(self, guild_id, user_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.rank(user_id)
+
+    async def _rpc_top(self, guild_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.top_balances.top()
+
+    async def _rpc_list_items(self, guild_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.list_items()
+
+    async def _rpc_add_item(self, guild_id, *args):
+        economy = await self.economies.get(guild_id)
+        return await economy.add_item(*args)
+
+    async def _rpc_remove_item(self, guild_id, item_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.remove_item(item_id)
+
+    async def _rpc_list_gacha_roles(self, guild_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.list_gacha_roles()
+
+    async def _rpc_add_gacha_role(self, guild_id, *args):
+        economy = await self.economies.get(guild_id)
+        return await economy.add_gacha_role(*args)
+
+    async def _rpc_remove_gacha_role(self, guild_id, role_id):
+        economy = await self.economies.get(guild_id)
+        return await economy.remove_gacha_role(role_id)
+
+    # v3 より前のデータは SQLite にしか無い
+    async def _rpc_adopt_legacy(self, guild_id, role_guilds, target):
+        economies = self.economies
+        if not isinstance(economies, EconomyRegistry):
+            return 0
+        await economies.ledger.flush()
+        moved, remaining = await adopt_legacy_rows(economies.db,
+                                                   dict(role_guilds), target)
+        # 何も移していなければキャッシュ（順位表など）はそのまま使える
+        if moved:
+            for economy in economies:
+                economy.invalidate()
+                self.invalidate(economy.guild_id)
+        return remaining
+
+
+# シャード側の接続（切れたら次の呼び出しでつなぎ直す）
+class LedgerClient:
+
+    def __init__(self, address):
+        self.address = address
+        self.on_invalidate = None  # on_invalidate(guild_id)
+        self._batcher = None
+        self._reader_task = None
+        self._lock = asyncio.Lock()
+        self._waiting = {}
+        self._next_id = 1
+        self._closing = False
+
+    async def connect(self):
+        async with self._lock:
+            if self._batcher is not None:
+                return
+            path, port = parse_address(self.address)
+            if port is None:
+                reader, writer = await asyncio.open_unix_connection(
+                    path, limit=LINE_LIMIT)
+            else:
+                reader, writer = await asyncio.open_connection(
+                    path, port, limit=LINE_LIMIT)
+            self._batcher = _Batcher(writer)
+            self._reader_task = asyncio.create_task(self._read(reader))
+
+    async def _read(self, reader):
+        error = LedgerServiceError("ledger service disconnected")
+        try:
+            async for messages in _read_lines(reader):
+                for call_id, ok, result in messages:
+                    if call_id == 0:
+                        if ok == 'invalidate' and self.on_invalidate:
+                            self.on_invalidate(result)
+                        continue
+                    future = self._waiting.pop(call_id, None)
+                    if future is None or future.done():
+                        continue
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(LedgerServiceError(result))
+        except (ConnectionError, ValueError) as e:
+            error = LedgerServiceError(f"ledger service disconnected: {e}")
+        finally:
+            self._batcher.writer.close()
+            self._batcher = None
+            waiting, self._waiting = self._waiting, {}
+            for future in waiting.values():
+                if not future.done():
+                    future.set_exception(error)
+            if not self._closing:
+                print("レジャーサービスとの接続が切れました")
+
+    async def call(self, guild_id, method, *args):
+        if self._batcher is None:
+            await self.connect()
+        batcher = self._batcher
+        if batcher is None:
+            raise LedgerServiceError("ledger service disconnected")
+
+        call_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[call_id] = future
+        batcher.send([call_id, guild_id, method, args])
+        return await future
+
+    async def close(self):
+        self._closing = True
+        if self._reader_task is not None and self._batcher is not None:
+            self._batcher.writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+
+class _RemoteTopBalances:
+
+    def __init__(self, client, guild_id):
+        self.client = client
+        self.guild_id = guild_id
+
+    async def top(self):
+        rows = await self.client.call(self.guild_id, 'top')
+        return [tuple(row) for row in rows]
+
+
+# GuildEconomy と同じ使い方で、操作をレジャーサービスに依頼する
+class RemoteEconomy:
+
+    def __init__(self, guild_id, client):
+        self.guild_id = guild_id
+        self.client = client
+        self.top_balances = _RemoteTopBalances(client, guild_id)
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+    async def get_balance(self, user_id):
+        return await self.client.call(self.guild_id, 'get_balance', user_id)
+
+    async def adjust(self, user_id, delta, required=None):
+        return await self.client.call(self.guild_id, 'adjust', user_id, delta,
+                                      required)
+
+    # 全員ぶんを1回の呼び出しで送り、サービス側で1トランザクションにする
+    # （分けて送ると途中で失敗したときに一部だけ反映され、やり直すと二重に入る）。
+    # 読み込みの途中経過はサービス側にあるので progress は呼ばない
+    async def adjust_many(self, deltas, progress=None):
+        return dict(await self.client.call(self.guild_id, 'adjust_many',
+                                           list(deltas.items())))
+
+    async def purchase(self, user_id, item_id, quantity=1):
+        return PurchaseResult(*await self.client.call(
+            self.guild_id, 'purchase', user_id, item_id, quantity))
+
+    async def rank(self, user_id):
+        rank, total, balance, above, below = await self.client.call(
+            self.guild_id, 'rank', user_id)
+        return RankResult(rank, total, balance,
+                          tuple(above) if above else None,
+                          tuple(below) if below else None)
+
+    async def claim_daily(self, user_id, day, amount, streak_bonus, streak_max):
+        claimed = await self.client.call(self.guild_id, 'claim_daily',
+                                         user_id, day, amount, streak_bonus,
+                                         streak_max)
+        return tuple(claimed) if claimed is not None else None
+
+    async def list_items(self):
+        rows = await self.client.call(self.guild_id, 'list_items')
+        return [tuple(row) for row in rows]
+
+    async def add_item(self, name, price, description, stock=-1,
+                       restock_to=None):
+        await self.client.call(self.guild_id, 'add_item', name, price,
+                               description, stock, restock_to)
+        self.shop_pages = None
+
+    async def remove_item(self, item_id):
+        name = await self.client.call(self.guild_id, 'remove_item', item_id)
+        self.shop_pages = None
+        return name
+
+    async def list_gacha_roles(self):
+        rows = await self.client.call(self.guild_id, 'list_gacha_roles')
+        return [tuple(row) for row in rows]
+
+    async def add_gacha_role(self, role_id, role_name, probability,
+                             description):
+        added = await self.client.call(self.guild_id, 'add_gacha_role',
+                                       role_id, role_name, probability,
+                                       description)
+        self.gacha_sampler = None
+        return added
+
+    async def remove_gacha_role(self, role_id):
+        name = await self.client.call(self.guild_id, 'remove_gacha_role',
+                                      role_id)
+        self.gacha_sampler = None
+        return name
+
+    def invalidate(self):
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+
+class RemoteEconomyRegistry:
+
+    def __init__(self, client):
+        self.client = client
+        self._economies = {}
+        client.on_invalidate = self._invalidate
+
+    def __iter__(self):
+        return iter(self._economies.values())
+
+    async def start(self):
+        await self.client.connect()
+
+    async def get(self, guild_id):
+        economy = self._economies.get(guild_id)
+        if economy is None:
+            economy = self._economies[guild_id] = RemoteEconomy(
+                guild_id, self.client)
+        return economy
+
+    def _invalidate(self, guild_id):
+        economy = self._economies.get(guild_id)
+        if economy is not None:
+            economy.invalidate()
+
+    # このシャードのギルドを定期ジョブの対象として登録する
+    async def register_guilds(self, guild_ids):
+        await self.client.call(0, 'guilds', list(guild_ids))
+
+    async def adopt_legacy(self, role_guilds, target):
+        return await self.client.call(0, 'adopt_legacy',
+                                      list(role_guilds.items()), target)
+
+    async def close(self):
+        await self.client.close()
+
+
+async def serve():
+    load_dotenv()
+    metrics = Metrics()
+    # STORAGE で保存先を選べる（定期ジョブは SQLite のときだけ）
+    economies = storage_from_env(os.environ, metrics.observe_query)
+    service = LedgerService(economies)
+    economy_jobs = EconomyJobs(
+        economies,
+        lambda: sorted(service.guild_ids),
+        jobs_from_env(os.environ),
+        run_at=datetime.strptime(os.getenv('ECONOMY_JOBS_TIME', '00:00'),
+                                 '%H:%M').time().replace(tzinfo=timezone.utc),
+        restock_hours=float(os.getenv('RESTOCK_INTERVAL_HOURS', '0')),
+        chunk_size=int(os.getenv('JOB_CHUNK_SIZE', '1000')),
+        on_restock=service.invalidate)
+
+    await economies.start()
+    metrics_port = os.getenv('LEDGER_METRICS_PORT')
+    try:
+        await service.start(os.getenv('LEDGER_SERVICE', 'unix:ledger.sock'))
+        if isinstance(economies, EconomyRegistry):
+            economy_jobs.start()
+        if metrics_port:
+            await metrics.start_server(os.getenv('METRICS_HOST', '127.0.0.1'),
+                                       int(metrics_port))
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        economy_jobs.stop()
+        await service.close()
+        await metrics.stop_server()
+        await economies.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -1,300 +1,656 @@
 import discord
+from discord import app_commands
 from discord.ext import commands
-import aiosqlite
-import random
 import os
 import asyncio
-from datetime import datetime, timedelta
+import csv
+import io
+import signal
+import time
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
+from database import adopt_legacy_rows
+from games import SLOT_JACKPOT, SLOT_SYMBOLS, AliasSampler, spin_slots
+from jobs import EconomyJobs, jobs_from_env
+from ledger_service import LedgerClient, RemoteEconomyRegistry
+from metrics import Metrics
+from roles import RoleGrantQueue
+from storage import storage_from_env
+from throttle import Throttle, limits_from_env
+from tree_sync import tree_sync_from_env
+
 load_dotenv()
 
+# コマンド・DBの計測
+metrics = Metrics()
+
+# コマンドの連打制限（THROTTLE_SLOT=5/10,100/10 などで上書き、THROTTLE=off で無効）
+throttle = Throttle(limits_from_env(os.environ))
+
+# 応答期限（3秒）に間に合わなさそうなら、Interaction 作成からこの秒数で自動的に defer する
+DEFER_AFTER = float(os.getenv('DEFER_AFTER', '2.0'))
+
+
+# 一定時間たっても応答していなければ defer する（コマンド開始時に仕掛ける）
+def arm_deferral(interaction):
+    age = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    lock = asyncio.Lock()
+    task = asyncio.create_task(
+        _defer_later(interaction, lock, max(0.0, DEFER_AFTER - age)))
+    interaction.extras['deferral'] = (lock, task)
+
+
+def disarm_deferral(interaction):
+    deferral = interaction.extras.pop('deferral', None)
+    if deferral is not None:
+        deferral[1].cancel()
+
+
+async def _defer_later(interaction, lock, delay):
+    await asyncio.sleep(delay)
+    async with lock:
+        if interaction.response.is_done():
+            return
+        command = interaction.command
+        metrics.command_deferred(command.qualified_name if command else
+                                 'unknown')
+        ephemeral = replies_ephemeral(interaction)
+        await interaction.response.defer(thinking=True, ephemeral=ephemeral)
+        metrics.command_acknowledged(interaction)
+        # 最初の followup は「考え中…」のメッセージを置き換え、その公開範囲を引き継ぐ
+        interaction.extras['deferred_ephemeral'] = ephemeral
+
+
+# 本人にだけ返すコマンドか（extras={'ephemeral': True}、引数で変わるなら namespace を受け取る関数）
+# defer もこれに合わせ、自動の defer で応答が公開されないようにする
+def replies_ephemeral(interaction):
+    command = interaction.command
+    ephemeral = command.extras.get('ephemeral', False) if command else False
+    if callable(ephemeral):
+        ephemeral = ephemeral(interaction.namespace)
+    return bool(ephemeral)
+
+
+# コマンドの応答（defer 済みなら followup で送る）
+async def reply(interaction, content=None, **kwargs):
+    deferral = interaction.extras.get('deferral')
+    if deferral is None:
+        return await _send(interaction, content, **kwargs)
+
+    lock, task = deferral
+    async with lock:
+        # ロックを取れた時点で defer は終わっているか、まだ始まっていない
+        task.cancel()
+        return await _send(interaction, content, **kwargs)
+
+
+async def _send(interaction, content, **kwargs):
+    if interaction.response.is_done():
+        deferred = interaction.extras.pop('deferred_ephemeral', None)
+        if deferred is not None and deferred != kwargs.get('ephemeral', False):
+            # 公開範囲が違う（公開のコマンドのエラーなど）ので「考え中…」を消して別に送る
+            await interaction.delete_original_response()
+        return await interaction.followup.send(content, **kwargs)
+    response = await interaction.response.send_message(content, **kwargs)
+    metrics.command_acknowledged(interaction)
+    return response
+
+
+# 全スラッシュコマンドの前後で計測するコマンドツリー
+class BotTree(app_commands.CommandTree):
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # 経済はサーバーごとなので DM では使えない
+        if interaction.guild_id is None:
+            await interaction.response.send_message(
+                "This bot can only be used in a server.", ephemeral=True)
+            return False
+
+        # 連打は DB に触れる前にここで断る
+        command = interaction.command
+        if command is not None:
+            retry_after = throttle.check(command.qualified_name,
+                                         interaction.user.id,
+                                         interaction.guild_id)
+            if retry_after:
+                metrics.command_throttled(command.qualified_name)
+                await interaction.response.send_message(
+                    f"Slow down! Try again in {retry_after:.1f}s.",
+                    ephemeral=True)
+                return False
+
+        metrics.command_started(interaction)
+        arm_deferral(interaction)
+        return True
+
+    async def on_error(self, interaction: discord.Interaction,
+                       error: app_commands.AppCommandError):
+        disarm_deferral(interaction)
+        metrics.command_finished(interaction, failed=True)
+        if isinstance(error, app_commands.CheckFailure):
+            return
+        await super().on_error(interaction, error)
+
+
 # Bot設定
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix='!', intents=intents)
+# /bulkmoney role・everyone でメンバー一覧を使う（Developer Portal で Server Members Intent の有効化が必要）
+intents.members = os.getenv('MEMBERS_INTENT', '0') == '1'
+
+
+# SHARD_IDS="0-3" や "0,2" をシャード番号のリストにする
+def parse_shard_ids(text):
+    shard_ids = []
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        first, _, last = part.partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+
+# 複数プロセスで動かすときは SHARD_COUNT（全体のシャード数）と SHARD_IDS（このプロセスの担当）を指定する
+# データベースは LEDGER_SERVICE のレジャーサービスに任せる（ledger_service.py を参照）
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='!',
+        intents=intents,
+        tree_cls=BotTree,
+        shard_count=SHARD_COUNT,
+        shard_ids=parse_shard_ids(os.getenv('SHARD_IDS', '')) or None)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=BotTree)
+# スラッシュコマンドの同期（変更があったときだけ）
+tree_sync = tree_sync_from_env(bot.tree, os.environ)
+
+# サーバー（ギルド）ごとの経済
+# STORAGE で保存先を選ぶ（sqlite / memory / postgres、設定は storage.storage_from_env を参照）
+STORAGE = os.getenv('STORAGE', 'sqlite').lower()
+economies = storage_from_env(os.environ, metrics.observe_query)
+
+# LEDGER_SERVICE（unix:/path か host:port）を指定すると、データベース・定期ジョブは
+# レジャーサービスが持ち、このプロセスは残高・在庫の操作を依頼するだけになる
+LEDGER_SERVICE = os.getenv('LEDGER_SERVICE')
+if LEDGER_SERVICE:
+    economies = RemoteEconomyRegistry(LedgerClient(LEDGER_SERVICE))
+
+# 定期ジョブと v3 より前のデータの引き取りは、このプロセスが SQLite を持つときだけ
+LOCAL_SQLITE = STORAGE == 'sqlite' and not LEDGER_SERVICE
+
+
+# データベース初期化（起動時に一度だけ。SQLite のスキーマはマイグレーションで更新）
+async def init_db():
+    await economies.start()
 
 
-# データベース初期化
-async def init_db():
-    async with aiosqlite.connect('bot_database.db') as db:
-        # ユーザーのお金を管理するテーブル
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_money (
-                user_id INTEGER PRIMARY KEY,
-                balance INTEGER DEFAULT 1000,
-                last_daily DATE
-            )
-        ''')
-
-        # 既存テーブルにlast_dailyカラムを追加（存在しない場合）
-        try:
-            await db.execute(
-                'ALTER TABLE user_money ADD COLUMN last_daily DATE')
-        except:
-            pass  # カラムが既に存在する場合はエラーを無視
-
-        # ショップアイテムを管理するテーブル
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS shop_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                description TEXT,
-                stock INTEGER DEFAULT -1
-            )
-        ''')
-
-        # ガチャロールを管理するテーブル
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS gacha_roles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                role_id INTEGER NOT NULL,
-                role_name TEXT NOT NULL,
-                probability REAL NOT NULL,
-                description TEXT
-            )
-        ''')
-
-        # 既存テーブルからcostカラムを削除（存在する場合）
-        try:
-            await db.execute('ALTER TABLE gacha_roles DROP COLUMN cost')
-        except:
-            pass  # カラムが存在しない場合はエラーを無視
+async def close_db():
+    await economies.close()
+
+
+# 定期ジョブ（利息・富裕税・減衰は毎日 ECONOMY_JOBS_TIME（UTC）に、補充は RESTOCK_INTERVAL_HOURS ごと）
+# INTEREST_RATE・WEALTH_TAX_RATE・DECAY_RATE などの設定は jobs.jobs_from_env を参照
+economy_jobs = EconomyJobs(
+    economies,
+    lambda: [guild.id for guild in bot.guilds],
+    jobs_from_env(os.environ),
+    run_at=datetime.strptime(os.getenv('ECONOMY_JOBS_TIME', '00:00'),
+                             '%H:%M').time().replace(tzinfo=timezone.utc),
+    restock_hours=float(os.getenv('RESTOCK_INTERVAL_HOURS', '0')),
+    chunk_size=int(os.getenv('JOB_CHUNK_SIZE', '1000')),
+    before=bot.wait_until_ready)
+
+# ガチャのロール付与（コマンドはキューに積んですぐ応答する）
+role_grants = RoleGrantQueue(
+    max_retries=int(os.getenv('ROLE_GRANT_RETRIES', '5')),
+    interval=float(os.getenv('ROLE_GRANT_INTERVAL', '0')))
+
+# 実行中のバックグラウンドタスク（途中で GC されないよう参照を持つ）
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# ロールを付与できなかったら本人にだけ知らせる
+async def report_role_grant(interaction, grant):
+    error = await grant
+    if error is None:
+        return
+
+    if isinstance(error, discord.Forbidden):
+        message = "Error: Bot doesn't have permission to assign roles."
+    else:
+        message = f"Error occurred while assigning roles: {error}"
+    try:
+        await interaction.followup.send(message, ephemeral=True)
+    except discord.HTTPException as e:
+        print(f"ロール付与の失敗を通知できませんでした: {e}")
 
-        await db.commit()
 
+# コマンドを実行したサーバーの経済
+async def get_economy(interaction):
+    return await economies.get(interaction.guild_id)
 
-# ユーザーの残高取得・初期化
-async def get_user_balance(user_id):
-    async with aiosqlite.connect('bot_database.db') as db:
-        cursor = await db.execute(
-            'SELECT balance FROM user_money WHERE user_id = ?', (user_id, ))
-        result = await cursor.fetchone()
 
-        if result is None:
-            await db.execute(
-                'INSERT INTO user_money (user_id, balance) VALUES (?, ?)',
-                (user_id, 1000))
-            await db.commit()
-            return 1000
+# ガチャ抽選器（ロールの追加・削除時に作り直す）
+async def get_gacha_sampler(economy):
+    if economy.gacha_sampler is None:
+        roles = await economy.list_gacha_roles()
+        economy.gacha_sampler = AliasSampler(roles,
+                                             [role[2] for role in roles])
+    return economy.gacha_sampler
 
-        return result[0]
 
+# 表示名キャッシュ（TTL付き）
+NAME_CACHE_TTL = 600
+NAME_CACHE_MAX = 5000
+display_names = {}
 
-# ユーザーの残高更新
-async def update_user_balance(user_id, new_balance):
-    async with aiosqlite.connect('bot_database.db') as db:
-        await db.execute('UPDATE user_money SET balance = ? WHERE user_id = ?',
-                         (new_balance, user_id))
-        await db.commit()
+
+async def resolve_display_name(user_id):
+    now = time.monotonic()
+    cached = display_names.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    try:
+        user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        name = user.display_name
+    except discord.HTTPException:
+        return f"Unknown User ({user_id})"
+
+    if len(display_names) >= NAME_CACHE_MAX:
+        # 期限切れを捨て、それでも多ければ古い順に捨てる
+        for key in [k for k, v in display_names.items() if v[1] <= now]:
+            del display_names[key]
+        while len(display_names) >= NAME_CACHE_MAX:
+            del display_names[next(iter(display_names))]
+
+    display_names[user_id] = (name, now + NAME_CACHE_TTL)
+    return name
+
+
+# v3 より前のデータ（サーバー未割り当て）を引き取る
+# ガチャロールはそのロールがあるサーバーへ。残りは LEGACY_GUILD_ID のサーバーか、
+# ボットが1つのサーバーにしか入っていなければそのサーバーへ移す。
+legacy_adopted = False  # このプロセスで移行済みか（再接続では何もしない）
+
+
+async def adopt_legacy_data():
+    global legacy_adopted
+    if legacy_adopted:
+        return
+
+    role_guilds = {
+        role.id: guild.id
+        for guild in bot.guilds for role in guild.roles
+    }
+    target = os.getenv('LEGACY_GUILD_ID')
+    if target:
+        target = int(target)
+    elif len(bot.guilds) == 1 and not SHARD_COUNT:
+        target = bot.guilds[0].id
+    else:
+        target = None
+
+    if LEDGER_SERVICE:
+        remaining = await economies.adopt_legacy(role_guilds, target)
+    else:
+        await economies.ledger.flush()
+        moved, remaining = await adopt_legacy_rows(economies.db, role_guilds,
+                                                   target)
+        if moved:
+            for economy in economies:
+                economy.invalidate()
+    legacy_adopted = True
+    if remaining:
+        print(f"サーバー未割り当てのデータが {remaining} 件残っています"
+              "（LEGACY_GUILD_ID で移行先を指定できます）")
 
 
 @bot.event
 async def on_ready():
     print(f'{bot.user} としてログインしました！')
-    await init_db()
 
-    # スラッシュコマンドを同期
+    # レジャーサービスの定期ジョブの対象にこのシャードのギルドを加える
+    if LEDGER_SERVICE:
+        try:
+            await economies.register_guilds(guild.id for guild in bot.guilds)
+        except Exception as e:
+            print(f"レジャーサービスへのギルドの登録に失敗しました: {e}")
+
     try:
-        synced = await bot.tree.sync()
-        print(f"{len(synced)} 個のスラッシュコマンドを同期しました")
+        if LOCAL_SQLITE or LEDGER_SERVICE:
+            await adopt_legacy_data()
+    except Exception as e:
+        print(f"既存データの移行に失敗しました: {e}")
+
+    # スラッシュコマンドを同期（再接続時・変更がないときは省略）
+    try:
+        await tree_sync.sync(bot.application_id)
     except Exception as e:
         print(f"スラッシュコマンドの同期に失敗しました: {e}")
 
 
+@bot.event
+async def on_guild_join(guild):
+    if LEDGER_SERVICE:
+        try:
+            await economies.register_guilds([guild.id])
+        except Exception as e:
+            print(f"レジャーサービスへのギルドの登録に失敗しました: {e}")
+
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction,
+                                    command):
+    disarm_deferral(interaction)
+    metrics.command_finished(interaction)
+
+
 # スロットマシンコマンド
 @bot.tree.command(
     name="slot",
     description="Play slot machine! Bet money and try to get triple matches")
-async def slot_machine(interaction: discord.Interaction, bet_amount: int):
+@app_commands.describe(bet_amount="Bet per spin",
+                       spins="Number of spins (1-100)")
+async def slot_machine(interaction: discord.Interaction,
+                       bet_amount: int,
+                       spins: app_commands.Range[int, 1, 100] = 1):
     user_id = interaction.user.id
+    economy = await get_economy(interaction)
 
     if bet_amount <= 0:
-        await interaction.response.send_message(
-            "Bet amount must be 1 or more!", ephemeral=True)
+        await reply(interaction,
+                    "Bet amount must be 1 or more!",
+                    ephemeral=True)
         return
 
-    current_balance = await get_user_balance(user_id)
-
-    if current_balance < bet_amount:
-        await interaction.response.send_message(
-            f"Insufficient balance! Current: {current_balance} coins",
-            ephemeral=True)
+    # スロット結果生成・勝利判定（配当表で全スピンまとめて計算）
+    reels, multipliers = spin_slots(spins)
+    total_bet = bet_amount * spins
+    win_amount = bet_amount * sum(multipliers)
+
+    # Update balance (all bets must be covered by the current balance)
+    new_balance = await economy.adjust(user_id,
+                                       win_amount - total_bet,
+                                       required=total_bet)
+    if new_balance is None:
+        current_balance = await economy.get_balance(user_id)
+        await reply(interaction,
+                    f"Insufficient balance! Current: {current_balance} coins",
+                    ephemeral=True)
         return
 
-    # スロットのシンボル
-    symbols = ['🍒', '🍋', '🍊', '🍇', '🍎', '💎', '⭐', '7️⃣']
-
-    # スロット結果生成
-    result = [random.choice(symbols) for _ in range(3)]
-
-    # 勝利判定
-    win_amount = 0
-    if result[0] == result[1] == result[2]:
-        if result[0] == '💎':
-            win_amount = bet_amount * 10  # Diamond is 10x
-        elif result[0] == '7️⃣':
-            win_amount = bet_amount * 15  # Lucky 7 is 15x
-        elif result[0] == '⭐':
-            win_amount = bet_amount * 8  # Star is 8x
-        else:
-            win_amount = bet_amount * 5  # Others are 5x
-    elif len(set(result)) == 2:  # Two matches
-        win_amount = bet_amount * 2
-
-    # Update balance
-    new_balance = current_balance - bet_amount + win_amount
-    await update_user_balance(user_id, new_balance)
-
     # 結果表示
     embed = discord.Embed(
         title="🎰 スロットマシン 🎰",
-        color=0x00ff00 if win_amount > bet_amount else 0xff0000)
-    embed.add_field(name="結果", value=" ".join(result), inline=False)
-    embed.add_field(name="Bet", value=f"{bet_amount} coins", inline=True)
+        color=0x00ff00 if win_amount > total_bet else 0xff0000)
 
-    if win_amount > 0:
-        profit = win_amount - bet_amount
+    if spins == 1:
+        result = [SLOT_SYMBOLS[i] for i in reels[0]]
+        embed.add_field(name="結果", value=" ".join(result), inline=False)
+        embed.add_field(name="Bet", value=f"{bet_amount} coins", inline=True)
+
+        if win_amount > 0:
+            profit = win_amount - bet_amount
+            embed.add_field(name="Won",
+                            value=f"{win_amount} coins",
+                            inline=True)
+            embed.add_field(name="Profit",
+                            value=f"+{profit} coins",
+                            inline=True)
+            if multipliers[0] >= SLOT_JACKPOT:
+                embed.add_field(name="🎉 JACKPOT!",
+                                value="Congratulations!",
+                                inline=False)
+        else:
+            embed.add_field(name="Result", value="Loss", inline=True)
+            embed.add_field(name="Loss",
+                            value=f"-{bet_amount} coins",
+                            inline=True)
+    else:
+        # 複数スピンは集計だけ表示
+        net = win_amount - total_bet
+        wins = sum(1 for m in multipliers if m > 0)
+        jackpots = sum(1 for m in multipliers if m >= SLOT_JACKPOT)
+        best = max(range(spins), key=multipliers.__getitem__)
+
+        embed.add_field(name="Spins", value=f"{spins}", inline=True)
+        embed.add_field(name="Total Bet",
+                        value=f"{total_bet} coins",
+                        inline=True)
         embed.add_field(name="Won", value=f"{win_amount} coins", inline=True)
-        embed.add_field(name="Profit", value=f"+{profit} coins", inline=True)
-        if win_amount >= bet_amount * 10:
+        embed.add_field(name="Wins",
+                        value=f"{wins}/{spins} ({wins / spins:.0%})",
+                        inline=True)
+        embed.add_field(name="Profit" if net >= 0 else "Loss",
+                        value=f"{net:+} coins",
+                        inline=True)
+        embed.add_field(
+            name="Best Spin",
+            value=" ".join(SLOT_SYMBOLS[i] for i in reels[best]) +
+            f" (x{multipliers[best]})",
+            inline=True)
+        if jackpots:
             embed.add_field(name="🎉 JACKPOT!",
-                            value="Congratulations!",
+                            value=f"x{jackpots} Congratulations!",
                             inline=False)
-    else:
-        embed.add_field(name="Result", value="Loss", inline=True)
-        embed.add_field(name="Loss", value=f"-{bet_amount} coins", inline=True)
 
     embed.add_field(name="New Balance",
                     value=f"{new_balance} coins",
                     inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Balance check command
-@bot.tree.command(name="balance", description="Check your current balance")
+@bot.tree.command(name="balance",
+                  description="Check your current balance",
+                  extras={'ephemeral': True})
 async def check_balance(interaction: discord.Interaction):
     user_id = interaction.user.id
-    balance = await get_user_balance(user_id)
+    economy = await get_economy(interaction)
+    balance = await economy.get_balance(user_id)
 
     embed = discord.Embed(title="💰 残高確認", color=0x00ff00)
     embed.add_field(name="Your Balance",
                     value=f"{balance} coins",
                     inline=False)
 
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await reply(interaction, embed=embed, ephemeral=True)
 
 
-# Shop display command
-@bot.tree.command(name="shop", description="Display shop items")
-async def shop(interaction: discord.Interaction):
-    async with aiosqlite.connect('bot_database.db') as db:
-        cursor = await db.execute(
-            'SELECT id, name, price, description, stock FROM shop_items')
-        items = await cursor.fetchall()
+# ショップカタログ（ページごとに描画済みの Embed をキャッシュ）
+SHOP_PAGE_SIZE = 10
 
-    if not items:
-        await interaction.response.send_message("No items in shop.",
-                                                ephemeral=True)
-        return
 
-    embed = discord.Embed(title="🛒 ショップ", color=0x0099ff)
+async def get_shop_pages(economy):
+    if economy.shop_pages is None:
+        items = await economy.list_items()
+        economy.shop_pages = render_shop_pages(items)
+    return economy.shop_pages
 
-    for item in items:
-        item_id, name, price, description, stock = item
-        stock_text = f"Stock: {stock}" if stock != -1 else "Stock: Unlimited"
-        embed.add_field(
-            name=f"{name} (ID: {item_id})",
-            value=f"Price: {price} coins\n{description}\n{stock_text}",
-            inline=False)
 
-    embed.add_field(name="How to buy",
-                    value="Use /buy <item_id> to purchase items",
-                    inline=False)
+def render_shop_pages(items):
+    chunks = [
+        items[i:i + SHOP_PAGE_SIZE]
+        for i in range(0, len(items), SHOP_PAGE_SIZE)
+    ]
+    pages = []
 
-    await interaction.response.send_message(embed=embed)
+    for page, chunk in enumerate(chunks, 1):
+        embed = discord.Embed(title="🛒 ショップ", color=0x0099ff)
 
+        for item in chunk:
+            item_id, name, price, description, stock = item
+            stock_text = f"Stock: {stock}" if stock != -1 else "Stock: Unlimited"
+            embed.add_field(
+                name=f"{name} (ID: {item_id})",
+                value=f"Price: {price} coins\n{description}\n{stock_text}",
+                inline=False)
 
-# Buy command
-@bot.tree.command(name="buy", description="Buy an item from the shop")
-async def buy_item(interaction: discord.Interaction, item_id: int):
-    user_id = interaction.user.id
+        embed.add_field(name="How to buy",
+                        value="Use /buy <item_id> to purchase items",
+                        inline=False)
+        if len(chunks) > 1:
+            embed.set_footer(text=f"Page {page}/{len(chunks)}")
+        pages.append(embed)
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        # Get item info
-        cursor = await db.execute(
-            'SELECT name, price, stock FROM shop_items WHERE id = ?',
-            (item_id, ))
-        item = await cursor.fetchone()
+    return pages
 
-        if not item:
-            await interaction.response.send_message(
-                "Item with specified ID not found.", ephemeral=True)
-            return
 
-        name, price, stock = item
+# ショップのページ送りボタン
+class ShopView(discord.ui.View):
 
-        # Check stock
-        if stock == 0:
-            await interaction.response.send_message(
-                "This item is out of stock.", ephemeral=True)
-            return
+    def __init__(self, owner_id, pages):
+        super().__init__(timeout=180)
+        self.owner_id = owner_id
+        self.pages = pages
+        self.page = 0
+        self.interaction = None  # 期限切れのときにボタンを無効化するため
+        self._update_buttons()
 
-        # Check balance
-        balance = await get_user_balance(user_id)
-        if balance < price:
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == len(self.pages) - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
             await interaction.response.send_message(
-                f"Insufficient balance. Need: {price} coins, Current: {balance} coins",
-                ephemeral=True)
+                "Use /shop to browse the shop yourself.", ephemeral=True)
+            return False
+        return True
+
+    # 期限切れのボタンは押しても失敗するので、押せない状態にしておく
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.interaction is None:
             return
+        try:
+            await self.interaction.edit_original_response(view=self)
+        except discord.HTTPException as e:
+            print(f"ショップのボタンを無効化できませんでした: {e}")
+
+    async def _show(self, interaction, page):
+        self.page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.pages[page],
+                                                view=self)
+
+    @discord.ui.button(label="◀ Prev", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction,
+                            button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction,
+                        button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
 
-        # Purchase process
-        new_balance = balance - price
-        await update_user_balance(user_id, new_balance)
+# Shop display command
+@bot.tree.command(name="shop", description="Display shop items")
+async def shop(interaction: discord.Interaction):
+    pages = await get_shop_pages(await get_economy(interaction))
+
+    if not pages:
+        await reply(interaction, "No items in shop.", ephemeral=True)
+        return
+
+    if len(pages) == 1:
+        await reply(interaction, embed=pages[0])
+        return
+
+    view = ShopView(interaction.user.id, pages)
+    view.interaction = interaction
+    await reply(interaction, embed=pages[0], view=view)
+
+
+# Buy command
+@bot.tree.command(name="buy", description="Buy an item from the shop")
+@app_commands.describe(item_id="Item ID from /shop",
+                       quantity="Number of items to buy (1-100)")
+async def buy_item(interaction: discord.Interaction,
+                   item_id: int,
+                   quantity: app_commands.Range[int, 1, 100] = 1):
+    user_id = interaction.user.id
+    economy = await get_economy(interaction)
+
+    # Purchase process (stock and balance are updated in one transaction)
+    result = await economy.purchase(user_id, item_id, quantity)
+
+    if result.status == 'not_found':
+        await reply(interaction,
+                    "Item with specified ID not found.",
+                    ephemeral=True)
+        return
 
-        # Update stock (if not unlimited)
-        if stock != -1:
-            await db.execute(
-                'UPDATE shop_items SET stock = stock - 1 WHERE id = ?',
-                (item_id, ))
+    # Check stock
+    if result.status == 'out_of_stock':
+        if result.stock == 0:
+            message = "This item is out of stock."
+        else:
+            message = f"Not enough stock. Remaining: {result.stock}"
+        await reply(interaction, message, ephemeral=True)
+        return
+
+    # Check balance
+    total_price = result.price * quantity
+    if result.status == 'insufficient':
+        await reply(interaction,
+                    f"Insufficient balance. Need: {total_price} coins, Current: {result.balance} coins",
+                    ephemeral=True)
+        return
 
-        await db.commit()
+    # Stock changed (if not unlimited)
+    if result.stock != -1:
+        economy.shop_pages = None
 
     embed = discord.Embed(title="✅ 購入完了", color=0x00ff00)
-    embed.add_field(name="Item", value=name, inline=True)
-    embed.add_field(name="Price", value=f"{price} coins", inline=True)
+    embed.add_field(name="Item", value=result.name, inline=True)
+    if quantity > 1:
+        embed.add_field(name="Quantity", value=f"{quantity}", inline=True)
+    embed.add_field(name="Price", value=f"{total_price} coins", inline=True)
     embed.add_field(name="New Balance",
-                    value=f"{new_balance} coins",
+                    value=f"{result.balance} coins",
                     inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Admin add item command
 @bot.tree.command(name="additem",
                   description="[Admin Only] Add a new item to the shop")
+@app_commands.describe(
+    restock="Refill a limited item to its starting stock on the restock timer")
 async def add_item(interaction: discord.Interaction,
                    item_name: str,
                    price: int,
                    description: str,
-                   stock: int = -1):
+                   stock: int = -1,
+                   restock: bool = False):
     # Check admin permissions
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message(
-            "This command is for administrators only.", ephemeral=True)
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
         return
 
     if price <= 0:
-        await interaction.response.send_message("Price must be 1 or more.",
-                                                ephemeral=True)
+        await reply(interaction, "Price must be 1 or more.", ephemeral=True)
         return
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        await db.execute(
-            'INSERT INTO shop_items (name, price, description, stock) VALUES (?, ?, ?, ?)',
-            (item_name, price, description, stock))
-        await db.commit()
+    # Limited items can be restocked to their initial stock on a timer
+    restock_to = stock if restock and stock != -1 else None
+
+    economy = await get_economy(interaction)
+    await economy.add_item(item_name, price, description, stock, restock_to)
 
     embed = discord.Embed(title="✅ 商品追加完了", color=0x00ff00)
     embed.add_field(name="Item Name", value=item_name, inline=True)
@@ -303,8 +659,10 @@ async def add_item(interaction: discord.Interaction,
     embed.add_field(name="Stock",
                     value="Unlimited" if stock == -1 else f"{stock}",
                     inline=True)
+    if restock_to is not None:
+        embed.add_field(name="Restock", value="Yes", inline=True)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Admin remove item command
@@ -313,27 +671,22 @@ async def add_item(interaction: discord.Interaction,
 async def remove_item(interaction: discord.Interaction, item_id: int):
     # 管理者権限チェック
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("このコマンドは管理者のみ使用できます。",
-                                                ephemeral=True)
+        await reply(interaction, "このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        cursor = await db.execute('SELECT name FROM shop_items WHERE id = ?',
-                                  (item_id, ))
-        item = await cursor.fetchone()
-
-        if not item:
-            await interaction.response.send_message(
-                "Item with specified ID not found.", ephemeral=True)
-            return
+    economy = await get_economy(interaction)
+    item_name = await economy.remove_item(item_id)
 
-        await db.execute('DELETE FROM shop_items WHERE id = ?', (item_id, ))
-        await db.commit()
+    if item_name is None:
+        await reply(interaction,
+                    "Item with specified ID not found.",
+                    ephemeral=True)
+        return
 
     embed = discord.Embed(title="✅ Item Removed", color=0xff0000)
-    embed.add_field(name="Removed Item", value=item[0], inline=False)
+    embed.add_field(name="Removed Item", value=item_name, inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Admin add money command
@@ -343,19 +696,20 @@ async def add_money(interaction: discord.Interaction, user: discord.Member,
                     amount: int):
     # Check admin permissions
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message(
-            "This command is for administrators only.", ephemeral=True)
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
         return
 
     if amount <= 0:
-        await interaction.response.send_message(
-            "Amount must be greater than 0.", ephemeral=True)
+        await reply(interaction,
+                    "Amount must be greater than 0.",
+                    ephemeral=True)
         return
 
-    # Get current balance and add money
-    current_balance = await get_user_balance(user.id)
-    new_balance = current_balance + amount
-    await update_user_balance(user.id, new_balance)
+    # Add money
+    economy = await get_economy(interaction)
+    new_balance = await economy.adjust(user.id, amount)
 
     embed = discord.Embed(title="💰 Money Added", color=0x00ff00)
     embed.add_field(name="User", value=user.mention, inline=True)
@@ -364,7 +718,194 @@ async def add_money(interaction: discord.Interaction, user: discord.Member,
                     value=f"{new_balance} coins",
                     inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
+
+
+# 一括入出金（イベントの配布など）
+# 対象ユーザーの残高をまとめて読み込み、1トランザクションで書き込む
+BULK_CSV_MAX_BYTES = 1024 * 1024
+BULK_PROGRESS_INTERVAL = 1.0  # 進捗メッセージを更新する間隔（秒）
+
+bulk_money = app_commands.Group(
+    name="bulkmoney",
+    description="[Admin Only] Add or remove money for many users at once")
+
+
+# サーバーのメンバー一覧（キャッシュが無ければ取得する）
+async def guild_members(guild):
+    if not guild.chunked:
+        if not bot.intents.members:
+            return None
+        await guild.chunk()
+    return guild.members
+
+
+def bulk_embed(title, description, color=0x0099ff):
+    return discord.Embed(title=title, description=description, color=color)
+
+
+async def run_bulk_adjust(interaction, deltas, target):
+    economy = await get_economy(interaction)
+    started = time.perf_counter()
+    last_update = started
+
+    async def progress(done, total):
+        nonlocal last_update
+        now = time.perf_counter()
+        if now - last_update < BULK_PROGRESS_INTERVAL:
+            return
+        last_update = now
+        await interaction.edit_original_response(embed=bulk_embed(
+            "⏳ Bulk Update", f"Loading balances... {done:,}/{total:,}"))
+
+    applied = await economy.adjust_many(deltas, progress)
+
+    credited = sum(delta for delta in applied.values() if delta > 0)
+    debited = -sum(delta for delta in applied.values() if delta < 0)
+    clamped = sum(1 for user_id, delta in applied.items()
+                  if delta != deltas[user_id])
+    embed = bulk_embed("✅ Bulk Update Complete", None, color=0x00ff00)
+    embed.add_field(name="Target", value=target, inline=False)
+    embed.add_field(name="Users", value=f"{len(deltas):,}", inline=True)
+    if credited:
+        embed.add_field(name="Added", value=f"{credited:,} coins", inline=True)
+    if debited:
+        embed.add_field(name="Removed",
+                        value=f"{debited:,} coins",
+                        inline=True)
+    if clamped:
+        embed.add_field(name="Stopped at 0",
+                        value=f"{clamped:,} users",
+                        inline=True)
+    embed.set_footer(text=f"Finished in {time.perf_counter() - started:.2f}s")
+    await interaction.edit_original_response(embed=embed)
+
+
+# 「Collecting members...」を送ったあとは、そのメッセージを書き換えて進める
+async def bulk_for_members(interaction, members, amount, target):
+    if members is None:
+        await interaction.edit_original_response(embed=bulk_embed(
+            "❌ Bulk Update", "The member list is not available. "
+            "Enable the Server Members Intent and set MEMBERS_INTENT=1.",
+            color=0xff0000))
+        return
+
+    deltas = {member.id: amount for member in members if not member.bot}
+    if not deltas:
+        await interaction.edit_original_response(embed=bulk_embed(
+            "❌ Bulk Update", "No matching members.", color=0xff0000))
+        return
+
+    await interaction.edit_original_response(embed=bulk_embed(
+        "⏳ Bulk Update",
+        f"Updating {len(deltas):,} users by {amount:+,} coins..."))
+    await run_bulk_adjust(interaction, deltas, target)
+
+
+@bulk_money.command(
+    name="role",
+    description="[Admin Only] Add money to every member of a role (negative to remove)")
+async def bulk_money_role(interaction: discord.Interaction,
+                          role: discord.Role, amount: int):
+    # Check admin permissions
+    if not interaction.user.guild_permissions.administrator:
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
+        return
+    if amount == 0:
+        await reply(interaction, "Amount must not be 0.", ephemeral=True)
+        return
+
+    await reply(interaction,
+                embed=bulk_embed("⏳ Bulk Update", "Collecting members..."))
+    members = await guild_members(interaction.guild)
+    if members is not None:
+        members = [member for member in members if role in member.roles]
+    await bulk_for_members(interaction, members, amount, role.mention)
+
+
+@bulk_money.command(
+    name="everyone",
+    description="[Admin Only] Add money to every member of the server (negative to remove)")
+async def bulk_money_everyone(interaction: discord.Interaction, amount: int):
+    # Check admin permissions
+    if not interaction.user.guild_permissions.administrator:
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
+        return
+    if amount == 0:
+        await reply(interaction, "Amount must not be 0.", ephemeral=True)
+        return
+
+    await reply(interaction,
+                embed=bulk_embed("⏳ Bulk Update", "Collecting members..."))
+    members = await guild_members(interaction.guild)
+    await bulk_for_members(interaction, members, amount, "Everyone")
+
+
+# CSV の読み込み（1行に user_id,amount。見出し行・空行は無視、同じユーザーは合算）
+def parse_bulk_csv(text):
+    deltas = {}
+    errors = []
+    for line_no, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        if not row or not ''.join(row).strip():
+            continue
+        try:
+            user_id, amount = int(row[0]), int(row[1])
+        except (ValueError, IndexError):
+            if line_no > 1:
+                errors.append(line_no)
+            continue
+        deltas[user_id] = deltas.get(user_id, 0) + amount
+    return deltas, errors
+
+
+@bulk_money.command(
+    name="csv",
+    description="[Admin Only] Add or remove money from a CSV of user_id,amount")
+@app_commands.describe(file="CSV file with one user_id,amount per line")
+async def bulk_money_csv(interaction: discord.Interaction,
+                         file: discord.Attachment):
+    # Check admin permissions
+    if not interaction.user.guild_permissions.administrator:
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
+        return
+    if file.size > BULK_CSV_MAX_BYTES:
+        await reply(interaction,
+                    f"File is too large (max {BULK_CSV_MAX_BYTES // 1024} KB).",
+                    ephemeral=True)
+        return
+
+    try:
+        text = (await file.read()).decode('utf-8-sig')
+    except (discord.HTTPException, UnicodeDecodeError) as e:
+        await reply(interaction, f"Could not read the file: {e}", ephemeral=True)
+        return
+
+    deltas, errors = parse_bulk_csv(text)
+    if errors:
+        shown = ", ".join(map(str, errors[:10]))
+        await reply(interaction,
+                    f"Invalid rows on line {shown}"
+                    f"{' ...' if len(errors) > 10 else ''}. Nothing was changed.",
+                    ephemeral=True)
+        return
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+    if not deltas:
+        await reply(interaction, "The file has no amounts.", ephemeral=True)
+        return
+
+    await reply(interaction,
+                embed=bulk_embed("⏳ Bulk Update",
+                                 f"Updating {len(deltas):,} users..."))
+    await run_bulk_adjust(interaction, deltas, file.filename)
+
+
+bot.tree.add_command(bulk_money)
 
 
 # Daily bonus command
@@ -373,88 +914,51 @@ async def daily_bonus(interaction: discord.Interaction):
     user_id = interaction.user.id
     today = datetime.now().date()
     daily_amount = 500  # Daily bonus amount
+    streak_bonus = 100  # Extra coins per consecutive day
+    streak_max = 7  # Streak bonus stops growing after a week
+    economy = await get_economy(interaction)
+
+    # Claim, streak and "already claimed" check in one statement
+    claimed = await economy.claim_daily(user_id, today.toordinal(),
+                                        daily_amount, streak_bonus,
+                                        streak_max)
+
+    if claimed is None:
+        # Already claimed today
+        balance = await economy.get_balance(user_id)
+        next_claim = today + timedelta(days=1)
+        embed = discord.Embed(title="⏰ Already Claimed", color=0xff9900)
+        embed.add_field(name="Status",
+                        value="You already claimed your daily bonus today!",
+                        inline=False)
+        embed.add_field(name="Next Claim",
+                        value=f"{next_claim.strftime('%Y-%m-%d')}",
+                        inline=True)
+        embed.add_field(name="Current Balance",
+                        value=f"{balance} coins",
+                        inline=True)
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        # Check when user last claimed daily bonus
-        cursor = await db.execute(
-            'SELECT balance, last_daily FROM user_money WHERE user_id = ?',
-            (user_id, ))
-        result = await cursor.fetchone()
-
-        if result is None:
-            # New user - create entry and give bonus
-            await db.execute(
-                'INSERT INTO user_money (user_id, balance, last_daily) VALUES (?, ?, ?)',
-                (user_id, 1000 + daily_amount, today))
-            await db.commit()
-
-            embed = discord.Embed(title="🎁 Daily Bonus!", color=0x00ff00)
-            embed.add_field(name="Welcome Bonus",
-                            value=f"+{daily_amount} coins",
-                            inline=True)
-            embed.add_field(name="New Balance",
-                            value=f"{1000 + daily_amount} coins",
-                            inline=True)
-            embed.add_field(name="Next Claim", value="Tomorrow!", inline=False)
-
-            await interaction.response.send_message(embed=embed)
-            return
+        await reply(interaction, embed=embed, ephemeral=True)
+        return
 
-        balance, last_daily = result
-
-        # Check if user already claimed today
-        if last_daily:
-            last_daily_date = datetime.strptime(last_daily, '%Y-%m-%d').date()
-            if last_daily_date >= today:
-                # Already claimed today
-                next_claim = today + timedelta(days=1)
-                embed = discord.Embed(title="⏰ Already Claimed",
-                                      color=0xff9900)
-                embed.add_field(
-                    name="Status",
-                    value="You already claimed your daily bonus today!",
-                    inline=False)
-                embed.add_field(name="Next Claim",
-                                value=f"{next_claim.strftime('%Y-%m-%d')}",
-                                inline=True)
-                embed.add_field(name="Current Balance",
-                                value=f"{balance} coins",
-                                inline=True)
-
-                await interaction.response.send_message(embed=embed,
-                                                        ephemeral=True)
-                return
-
-        # Give daily bonus
-        new_balance = balance + daily_amount
-        await db.execute(
-            'UPDATE user_money SET balance = ?, last_daily = ? WHERE user_id = ?',
-            (new_balance, today, user_id))
-        await db.commit()
-
-    # Calculate streak bonus (optional)
-    streak_bonus = 0
-    if last_daily:
-        last_daily_date = datetime.strptime(last_daily, '%Y-%m-%d').date()
-        if (today - last_daily_date).days == 1:  # Consecutive day
-            streak_bonus = 100
-            new_balance += streak_bonus
-            await update_user_balance(user_id, new_balance)
+    new_balance, bonus, streak = claimed
 
     embed = discord.Embed(title="🎁 Daily Bonus Claimed!", color=0x00ff00)
     embed.add_field(name="Daily Bonus",
                     value=f"+{daily_amount} coins",
                     inline=True)
-    if streak_bonus > 0:
+    if bonus > daily_amount:
         embed.add_field(name="Streak Bonus",
-                        value=f"+{streak_bonus} coins",
+                        value=f"+{bonus - daily_amount} coins",
                         inline=True)
+    if streak > 1:
+        embed.add_field(name="Streak", value=f"🔥 {streak} days", inline=True)
     embed.add_field(name="New Balance",
                     value=f"{new_balance} coins",
                     inline=False)
     embed.add_field(name="Next Claim", value="Tomorrow!", inline=True)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Admin add gacha role command
@@ -466,32 +970,27 @@ async def add_gacha_role(interaction: discord.Interaction,
                          description: str = ""):
     # Check admin permissions
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message(
-            "This command is for administrators only.", ephemeral=True)
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
         return
 
     if probability < 0.1 or probability > 100:
-        await interaction.response.send_message(
-            "Probability must be between 0.1 and 100.0", ephemeral=True)
+        await reply(interaction,
+                    "Probability must be between 0.1 and 100.0",
+                    ephemeral=True)
         return
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        # Check if role already exists
-        cursor = await db.execute(
-            'SELECT id FROM gacha_roles WHERE role_id = ?', (role.id, ))
-        existing = await cursor.fetchone()
-
-        if existing:
-            await interaction.response.send_message(
-                f"Role {role.mention} is already in gacha system!",
-                ephemeral=True)
-            return
+    # Add role to gacha (unless it already exists)
+    economy = await get_economy(interaction)
+    added = await economy.add_gacha_role(role.id, role.name, probability,
+                                         description)
 
-        # Add role to gacha
-        await db.execute(
-            'INSERT INTO gacha_roles (role_id, role_name, probability, description) VALUES (?, ?, ?, ?)',
-            (role.id, role.name, probability, description))
-        await db.commit()
+    if not added:
+        await reply(interaction,
+                    f"Role {role.mention} is already in gacha system!",
+                    ephemeral=True)
+        return
 
     embed = discord.Embed(title="🎲 Gacha Role Added", color=0x00ff00)
     embed.add_field(name="Role", value=role.mention, inline=True)
@@ -500,7 +999,7 @@ async def add_gacha_role(interaction: discord.Interaction,
                     value=description or "No description",
                     inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Admin remove gacha role command
@@ -510,43 +1009,37 @@ async def remove_gacha_role(interaction: discord.Interaction,
                             role: discord.Role):
     # Check admin permissions
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message(
-            "This command is for administrators only.", ephemeral=True)
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
         return
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        cursor = await db.execute(
-            'SELECT role_name FROM gacha_roles WHERE role_id = ?', (role.id, ))
-        existing = await cursor.fetchone()
-
-        if not existing:
-            await interaction.response.send_message(
-                f"Role {role.mention} is not in gacha system!", ephemeral=True)
-            return
+    economy = await get_economy(interaction)
+    removed = await economy.remove_gacha_role(role.id)
 
-        await db.execute('DELETE FROM gacha_roles WHERE role_id = ?',
-                         (role.id, ))
-        await db.commit()
+    if removed is None:
+        await reply(interaction,
+                    f"Role {role.mention} is not in gacha system!",
+                    ephemeral=True)
+        return
 
     embed = discord.Embed(title="🗑️ Gacha Role Removed", color=0xff0000)
     embed.add_field(name="Removed Role", value=role.mention, inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Gacha list command
 @bot.tree.command(name="gachalist",
                   description="View all available gacha roles")
 async def gacha_list(interaction: discord.Interaction):
-    async with aiosqlite.connect('bot_database.db') as db:
-        cursor = await db.execute(
-            'SELECT role_id, role_name, probability, description FROM gacha_roles ORDER BY probability DESC'
-        )
-        roles = await cursor.fetchall()
+    economy = await get_economy(interaction)
+    roles = sorted(await economy.list_gacha_roles(),
+                   key=lambda role: role[2],
+                   reverse=True)
 
     if not roles:
-        await interaction.response.send_message("No gacha roles available.",
-                                                ephemeral=True)
+        await reply(interaction, "No gacha roles available.", ephemeral=True)
         return
 
     embed = discord.Embed(title="🎲 Role Gacha List", color=0x9932cc)
@@ -566,159 +1059,135 @@ async def gacha_list(interaction: discord.Interaction):
 
     embed.add_field(
         name="How to play",
-        value="Use /gacha to try your luck! Cost: 100 coins per roll",
+        value=
+        "Use /gacha to try your luck! Cost: 100 coins per roll (up to 10 rolls at once)",
         inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
 
 # Role gacha command
 @bot.tree.command(name="gacha", description="Try your luck at role gacha!")
-async def role_gacha(interaction: discord.Interaction):
+@app_commands.describe(count="Number of rolls (1-10)")
+async def role_gacha(interaction: discord.Interaction,
+                     count: app_commands.Range[int, 1, 10] = 1):
     user_id = interaction.user.id
     gacha_cost = 100  # Fixed cost per gacha roll
+    total_cost = gacha_cost * count
+    economy = await get_economy(interaction)
 
-    async with aiosqlite.connect('bot_database.db') as db:
-        # Get all gacha roles
-        cursor = await db.execute(
-            'SELECT role_id, role_name, probability, description FROM gacha_roles'
-        )
-        roles = await cursor.fetchall()
-
-    if not roles:
-        await interaction.response.send_message(
-            "No gacha roles are currently available.", ephemeral=True)
-        return
-
-    # Check user balance
-    balance = await get_user_balance(user_id)
+    # Get the prebuilt sampler for this server's gacha roles
+    sampler = await get_gacha_sampler(economy)
 
-    if balance < gacha_cost:
-        await interaction.response.send_message(
-            f"Insufficient balance! You need {gacha_cost} coins to play gacha.",
-            ephemeral=True)
+    if not sampler.items:
+        await reply(interaction,
+                    "No gacha roles are currently available.",
+                    ephemeral=True)
         return
 
-    # Pay the gacha cost first
-    new_balance = balance - gacha_cost
-    await update_user_balance(user_id, new_balance)
-
-    # Weighted random selection based on probability
-    import random
-
-    # Calculate total probability weight
-    total_weight = sum(role[2] for role in roles)
-
-    # Add "miss" chance if total probability < 100
-    miss_chance = max(0, 100 - total_weight)
-
-    # Generate random number
-    rand = random.uniform(0, 100)
-    current = 0
-
-    selected_role = None
-    for role_id, role_name, probability, description in roles:
-        current += probability
-        if rand <= current:
-            selected_role = (role_id, role_name, probability, description)
-            break
-
-    # Check if it's a miss
-    if selected_role is None or rand > (100 - miss_chance):
-        embed = discord.Embed(title="💸 Gacha Result", color=0xff0000)
-        embed.add_field(name="Result",
-                        value="**MISS!** Better luck next time!",
-                        inline=False)
-        embed.add_field(name="Cost", value=f"{gacha_cost} coins", inline=True)
-        embed.add_field(name="New Balance",
-                        value=f"{new_balance} coins",
-                        inline=True)
+    # Pay for all rolls at once
+    new_balance = await economy.adjust(user_id, -total_cost)
 
-        await interaction.response.send_message(embed=embed)
+    if new_balance is None:
+        await reply(interaction,
+                    f"Insufficient balance! You need {total_cost} coins to play gacha.",
+                    ephemeral=True)
         return
 
-    # Success - give role (no additional cost)
-    role_id, role_name, probability, description = selected_role
-
-    try:
+    # Weighted random selection based on probability (None is a miss)
+    results = sampler.draw_many(count)
+    misses = results.count(None)
+
+    # Sort hits into new roles, duplicates and deleted roles
+    won = []
+    duplicates = {}
+    missing = {}
+    seen = set()
+    owned = {role.id for role in interaction.user.roles}
+    for selected_role in results:
+        if selected_role is None:
+            continue
+
+        role_id, role_name, probability, description = selected_role
         role = interaction.guild.get_role(role_id)
         if role is None:
-            await interaction.response.send_message(
-                "Error: Role no longer exists on this server.", ephemeral=True)
-            return
-
-        # Check if user already has the role
-        if role in interaction.user.roles:
-            embed = discord.Embed(title="🔄 Duplicate Role", color=0xff9900)
-            embed.add_field(name="Result",
-                            value=f"You already have {role.mention}!",
-                            inline=False)
-            embed.add_field(name="Cost",
-                            value=f"{gacha_cost} coins",
-                            inline=True)
-            embed.add_field(name="New Balance",
-                            value=f"{new_balance} coins",
-                            inline=True)
-
-            await interaction.response.send_message(embed=embed)
-            return
-
-        # Give role to user
-        await interaction.user.add_roles(role)
+            missing[role_name] = missing.get(role_name, 0) + 1
+        elif role_id in owned or role_id in seen:
+            duplicates[role] = duplicates.get(role, 0) + 1
+        else:
+            won.append((role, probability))
+        seen.add(role_id)
 
+    if won:
         embed = discord.Embed(title="🎉 Gacha Success!", color=0x00ff00)
         embed.add_field(name="Congratulations!",
-                        value=f"You won {role.mention}!",
+                        value="\n".join(f"You won {role.mention}! ({probability}%)"
+                                        for role, probability in won),
                         inline=False)
-        embed.add_field(name="Probability",
-                        value=f"{probability}%",
-                        inline=True)
-        embed.add_field(name="Cost", value=f"{gacha_cost} coins", inline=True)
-        embed.add_field(name="New Balance",
-                        value=f"{new_balance} coins",
+    elif duplicates:
+        embed = discord.Embed(title="🔄 Duplicate Role", color=0xff9900)
+    else:
+        embed = discord.Embed(title="💸 Gacha Result", color=0xff0000)
+
+    if duplicates:
+        embed.add_field(name="Duplicates",
+                        value="\n".join(
+                            f"You already have {role.mention}!" +
+                            (f" x{n}" if n > 1 else "")
+                            for role, n in duplicates.items()),
                         inline=False)
+    if missing:
+        embed.add_field(name="Unavailable",
+                        value="\n".join(
+                            f"@{name} no longer exists on this server" +
+                            (f" x{n}" if n > 1 else "")
+                            for name, n in missing.items()),
+                        inline=False)
+    if misses:
+        embed.add_field(name="Result",
+                        value="**MISS!** Better luck next time!"
+                        if count == 1 else f"**MISS** x{misses}",
+                        inline=False)
+
+    embed.add_field(name="Rolls", value=f"{count}", inline=True)
+    embed.add_field(name="Cost", value=f"{total_cost} coins", inline=True)
+    embed.add_field(name="New Balance",
+                    value=f"{new_balance} coins",
+                    inline=True)
 
-        await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
-    except discord.Forbidden:
-        await interaction.response.send_message(
-            "Error: Bot doesn't have permission to assign roles.",
-            ephemeral=True)
-    except Exception as e:
-        await interaction.response.send_message(f"Error occurred: {str(e)}",
-                                                ephemeral=True)
+    # Give all new roles in the background (no additional cost)
+    if won:
+        grant = role_grants.grant(interaction.user,
+                                  [role for role, _ in won],
+                                  reason="Role gacha")
+        run_in_background(report_role_grant(interaction, grant))
 
 
 # Leaderboard command
 @bot.tree.command(name="leaderboard",
                   description="View the top 10 richest users")
 async def leaderboard(interaction: discord.Interaction):
-    async with aiosqlite.connect('bot_database.db') as db:
-        # Get top 10 users by balance
-        cursor = await db.execute('''
-            SELECT user_id, balance 
-            FROM users 
-            WHERE balance > 0 
-            ORDER BY balance DESC 
-            LIMIT 10
-        ''')
-        top_users = await cursor.fetchall()
+    # Get top 10 users by balance
+    economy = await get_economy(interaction)
+    top_users = await economy.top_balances.top()
 
     if not top_users:
-        await interaction.response.send_message(
-            "No users with positive balance found.", ephemeral=True)
+        await reply(interaction,
+                    "No users with positive balance found.",
+                    ephemeral=True)
         return
 
     embed = discord.Embed(title="💰 Wealth Leaderboard", color=0xffd700)
     embed.set_footer(text="Top 10 Richest Users")
 
-    for i, (user_id, balance) in enumerate(top_users, 1):
-        try:
-            user = bot.get_user(user_id) or await bot.fetch_user(user_id)
-            username = user.display_name if user else f"Unknown User ({user_id})"
-        except:
-            username = f"Unknown User ({user_id})"
+    # Resolve all names at once
+    usernames = await asyncio.gather(
+        *(resolve_display_name(user_id) for user_id, _ in top_users))
 
+    for i, ((user_id, balance),
+            username) in enumerate(zip(top_users, usernames), 1):
         # Medal emojis for top 3
         if i == 1:
             rank_emoji = "🥇"
@@ -733,14 +1202,136 @@ async def leaderboard(interaction: discord.Interaction):
                         value=f"{balance:,} coins",
                         inline=False)
 
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
+
+
+# Rank command
+@bot.tree.command(
+    name="rank",
+    description="See where you (or another user) stand",
+    extras={'ephemeral': lambda namespace: namespace.user is None})
+@app_commands.describe(user="User to look up (defaults to you)")
+async def rank(interaction: discord.Interaction, user: discord.Member = None):
+    target = user or interaction.user
+    economy = await get_economy(interaction)
+    result = await economy.rank(target.id)
+
+    embed = discord.Embed(title="🏅 Rank", color=0xffd700)
+    embed.add_field(name="User", value=target.mention, inline=True)
+    embed.add_field(name="Rank",
+                    value=f"#{result.rank:,} / {result.total:,}",
+                    inline=True)
+    embed.add_field(name="Top",
+                    value=f"{result.rank / result.total:.1%}",
+                    inline=True)
+    embed.add_field(name="Balance",
+                    value=f"{result.balance:,} coins",
+                    inline=False)
+
+    # Users right above and below
+    neighbours = [(label, entry)
+                  for label, entry in (("Above", result.above),
+                                       ("Below", result.below)) if entry]
+    names = await asyncio.gather(
+        *(resolve_display_name(user_id) for _, (user_id, _) in neighbours))
+    for (label, (user_id, balance)), name in zip(neighbours, names):
+        embed.add_field(name=label,
+                        value=f"{name} ({balance:,} coins)",
+                        inline=True)
+
+    await reply(interaction, embed=embed, ephemeral=user is None)
+
+
+# Admin stats command
+@bot.tree.command(name="stats",
+                  description="[Admin Only] Show command latency statistics",
+                  extras={'ephemeral': True})
+async def stats(interaction: discord.Interaction):
+    # Check admin permissions
+    if not interaction.user.guild_permissions.administrator:
+        await reply(interaction,
+                    "This command is for administrators only.",
+                    ephemeral=True)
+        return
+
+    lines = [
+        f"{'command':<12}{'calls':>6}{'err':>5}{'p50ms':>7}{'p95ms':>7}"
+        f"{'q/call':>7}{'left':>7}"
+    ]
+    for name, command_stats in sorted(metrics.commands.items()):
+        calls = command_stats.latency.count
+        if not calls:
+            continue
+        lines.append(
+            f"{name:<12}{calls:>6}{command_stats.errors:>5}"
+            f"{command_stats.latency.quantile(0.5) * 1000:>7g}"
+            f"{command_stats.latency.quantile(0.95) * 1000:>7g}"
+            f"{command_stats.queries / calls:>7.1f}"
+            f"{command_stats.min_headroom:>6.2f}s")
+
+    embed = discord.Embed(title="📊 Bot Stats",
+                          description="```\n" + "\n".join(lines) + "\n```",
+                          color=0x0099ff)
+    for kind, histogram in sorted(metrics.db_queries.items()):
+        embed.add_field(
+            name=f"DB {kind}",
+            value=f"{histogram.count} calls\n"
+            f"p95 ≤ {histogram.quantile(0.95) * 1000:g} ms",
+            inline=True)
+    embed.set_footer(text="left = smallest time left before the 3s deadline")
+
+    await reply(interaction, embed=embed, ephemeral=True)
+
+
+# メトリクスの HTTP エンドポイントのポート（METRICS_PORT=0 で無効にする）
+# METRICS_PORT を省略すると 9108 + 担当する最初のシャード番号にして、同じホストの
+# 複数のシャードプロセスがポートを取り合わないようにする
+def metrics_port():
+    port = os.getenv('METRICS_PORT')
+    if port is not None:
+        return int(port)
+    shard_ids = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+    return 9108 + (shard_ids[0] if shard_ids else 0)
+
+
+async def start_metrics():
+    port = metrics_port()
+    if not port:
+        return
+    host = os.getenv('METRICS_HOST', '127.0.0.1')
+    try:
+        await metrics.start_server(host, port)
+    except OSError as e:
+        # 使用中のポートなどで公開できなくてもボットは動かす
+        print(f"メトリクスを {host}:{port} で公開できませんでした: {e}")
+        await metrics.stop_server()
+
+
+# ボット起動（終了時にデータベース接続を閉じる。起動の途中で失敗しても閉じる）
+async def main(token):
+    try:
+        await init_db()
+        if LOCAL_SQLITE:
+            economy_jobs.start()
+        elif economy_jobs.jobs and not LEDGER_SERVICE:
+            print(f"定期ジョブは SQLite でのみ動きます（STORAGE={STORAGE}）")
+        await start_metrics()
+        # SIGTERM（systemctl stop・docker stop）でもボットを閉じて、finally で未コミットの残高を書き込む
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        async with bot:
+            await bot.start(token)
+    finally:
+        economy_jobs.stop()
+        await metrics.stop_server()
+        await role_grants.close()
+        await close_db()
 
 
-# ボット起動
 if __name__ == "__main__":
     token = os.getenv('DISCORD_TOKEN')
     if not token:
         print("DISCORD_TOKEN が設定されていません。.env ファイルまたは環境変数を確認してください。")
     else:
-        asyncio.run(init_db())
-        bot.run(token)
+        discord.utils.setup_logging()
+        asyncio.run(main(token))
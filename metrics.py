@@ -0,0 +1,200 @@
+import bisect
+import contextvars
+import time
+
+import discord
+from aiohttp import web
+
+# コマンド・データベースの計測
+# 各値は固定バケットのヒストグラムとカウンターに積むだけなので、本番で常時有効にしても軽い。
+# Prometheus 形式で http://METRICS_HOST:METRICS_PORT/metrics に公開し、/stats でも表示する。
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.0, 3.0, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 1.0)
+
+# Discord の応答期限（秒）
+INTERACTION_DEADLINE = 3.0
+
+# 実行中のコマンド名（クエリ数をコマンドごとに数えるため）
+current_command = contextvars.ContextVar('current_command', default=None)
+
+
+# Interaction が作られてからの秒数
+def interaction_age(interaction):
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    # バケットの上限値で近似した分位点
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(
+                f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class CommandStats:
+    __slots__ = ('latency', 'age', 'errors', 'throttled', 'deferred',
+                 'queries', 'deadline_misses', 'min_headroom')
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.age = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+        self.throttled = 0
+        self.deferred = 0
+        self.queries = 0
+        self.deadline_misses = 0
+        self.min_headroom = INTERACTION_DEADLINE
+
+
+class Metrics:
+
+    def __init__(self):
+        self.commands = {}
+        self.db_queries = {}
+        self._runner = None
+
+    def _command(self, name):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats()
+        return stats
+
+    # コマンド開始（CommandTree.interaction_check から呼ぶ）
+    def command_started(self, interaction):
+        command = interaction.command
+        name = command.qualified_name if command else 'unknown'
+        interaction.extras['metrics'] = (name, time.perf_counter())
+        current_command.set(name)
+
+    # コマンド終了（成功・失敗とも）
+    def command_finished(self, interaction, failed=False):
+        started = interaction.extras.pop('metrics', None)
+        if started is None:
+            return
+
+        name, t0 = started
+        stats = self._command(name)
+        stats.latency.observe(time.perf_counter() - t0)
+        if failed:
+            stats.errors += 1
+
+        # 最初の応答（send_message か defer）までの Interaction の経過時間と、3秒の期限までの残り
+        # 応答できなかったコマンドは終了時の経過時間で数える
+        age = interaction.extras.pop('acknowledged', None)
+        if age is None:
+            age = interaction_age(interaction)
+        stats.age.observe(age)
+        headroom = INTERACTION_DEADLINE - age
+        stats.min_headroom = min(stats.min_headroom, headroom)
+        if headroom < 0:
+            stats.deadline_misses += 1
+
+    # 最初の応答を返した（期限に間に合ったかはこの時点の経過時間で決まる）
+    def command_acknowledged(self, interaction):
+        interaction.extras.setdefault('acknowledged',
+                                      interaction_age(interaction))
+
+    # 連打制限で断ったコマンド
+    def command_throttled(self, name):
+        self._command(name).throttled += 1
+
+    # 応答が遅れて自動的に defer したコマンド
+    def command_deferred(self, name):
+        self._command(name).deferred += 1
+
+    # データベース呼び出し1回ぶん（Database.observer に登録する）
+    def observe_query(self, kind, seconds):
+        histogram = self.db_queries.get(kind)
+        if histogram is None:
+            histogram = self.db_queries[kind] = Histogram(QUERY_BUCKETS)
+        histogram.observe(seconds)
+
+        name = current_command.get()
+        if name is not None:
+            self._command(name).queries += 1
+
+    # Prometheus テキスト形式（メトリクスごとに行をまとめる）
+    def render(self):
+        commands = sorted(self.commands.items())
+        lines = ['# TYPE bot_command_duration_seconds histogram']
+        for name, stats in commands:
+            lines += stats.latency.render('bot_command_duration_seconds',
+                                          f'command="{name}"')
+
+        lines.append('# TYPE bot_command_response_age_seconds histogram')
+        for name, stats in commands:
+            lines += stats.age.render('bot_command_response_age_seconds',
+                                      f'command="{name}"')
+
+        for metric, kind, attr in (
+            ('bot_command_errors_total', 'counter', 'errors'),
+            ('bot_command_throttled_total', 'counter', 'throttled'),
+            ('bot_command_deferred_total', 'counter', 'deferred'),
+            ('bot_command_queries_total', 'counter', 'queries'),
+            ('bot_command_deadline_misses_total', 'counter',
+             'deadline_misses'),
+            ('bot_command_deadline_headroom_min_seconds', 'gauge',
+             'min_headroom'),
+        ):
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, stats in commands:
+                lines.append(
+                    f'{metric}{{command="{name}"}} {getattr(stats, attr)}')
+
+        lines.append('# TYPE bot_db_query_duration_seconds histogram')
+        for kind, histogram in sorted(self.db_queries.items()):
+            lines += histogram.render('bot_db_query_duration_seconds',
+                                      f'kind="{kind}"')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    async def start_server(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"メトリクスを http://{host}:{port}/metrics で公開しています")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,129 @@
+import asyncio
+
+import discord
+
+# ロール付与キュー
+# コマンドはキューに積むだけですぐ応答し、付与はサーバーごとのワーカーが順番に行う。
+# Discord のメンバー更新のレート制限はサーバー単位なので、1サーバーにつき同時に1リクエストだけ送る。
+# 同じメンバーへの付与が溜まっていれば1回の add_roles にまとめる。
+# add_roles は atomic（ロールごとの PUT）のままにして、同時の付与で互いのロールを上書きしないようにする。
+# 5xx・通信エラーで失敗したメンバーは待ち時間つきでキューの後ろに戻し、その間に他のメンバーの付与を進める
+# （その場で待つと、1人の再試行（最大で約31秒）の間そのサーバーの付与がすべて止まる）。
+# RateLimited はサーバー全体の制限なので、ワーカーごと待つ。
+
+
+class RoleGrantQueue:
+
+    def __init__(self, max_retries=5, retry_delay=1.0, interval=0.0):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.interval = interval  # サーバーごとのリクエスト間隔（秒）
+        # guild_id -> {member_id: [member, roles, futures, reason, attempt, not_before]}
+        self._pending = {}
+        self._workers = {}  # guild_id -> Task
+
+    def __len__(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    # 付与を予約する。付与できれば None、諦めたら例外を結果に持つ Future を返す
+    def grant(self, member, roles, reason=None):
+        future = asyncio.get_running_loop().create_future()
+        guild_id = member.guild.id
+        pending = self._pending.setdefault(guild_id, {})
+
+        entry = pending.get(member.id)
+        if entry is None:
+            entry = pending[member.id] = [member, {}, [], reason, 0, 0.0]
+        else:
+            entry[0] = member  # 新しい Interaction のメンバーのほうがロール情報が新しい
+        for role in roles:
+            entry[1][role.id] = role
+        entry[2].append(future)
+
+        if guild_id not in self._workers:
+            self._workers[guild_id] = asyncio.create_task(self._run(guild_id))
+        return future
+
+    async def _run(self, guild_id):
+        loop = asyncio.get_running_loop()
+        pending = self._pending[guild_id]
+        try:
+            while pending:
+                # 再試行待ちでないメンバーを先頭から選ぶ（全員待ちなら一番早い時刻まで寝る）
+                now = loop.time()
+                member_id = next(
+                    (member_id for member_id, entry in pending.items()
+                     if entry[5] <= now), None)
+                if member_id is None:
+                    await asyncio.sleep(
+                        min(entry[5] for entry in pending.values()) - now)
+                    continue
+
+                entry = pending.pop(member_id)
+                member, roles, futures, reason, attempt, _ = entry
+                error, delay = await self._apply(member, list(roles.values()),
+                                                 reason, attempt)
+                if delay is not None and attempt < self.max_retries:
+                    print(f"ロールの付与に失敗しました（{delay:.1f}秒後に再試行）: {error}")
+                    self._requeue(pending, member_id, entry)
+                    if isinstance(error, discord.RateLimited):
+                        await asyncio.sleep(delay)
+                    else:
+                        entry[5] = loop.time() + delay
+                    continue
+
+                for future in futures:
+                    if not future.done():
+                        future.set_result(error)
+                if self.interval:
+                    await asyncio.sleep(self.interval)
+        finally:
+            del self._workers[guild_id]
+            if not pending:
+                del self._pending[guild_id]
+
+    # 再試行する付与をキューの後ろに戻す（付与中に同じメンバーへ積まれたぶんもまとめる）
+    def _requeue(self, pending, member_id, entry):
+        entry[4] += 1
+        newer = pending.pop(member_id, None)
+        if newer is not None:
+            entry[0] = newer[0]
+            entry[1].update(newer[1])
+            entry[2].extend(newer[2])
+        pending[member_id] = entry
+
+    # 1回だけ付与する。戻り値は (エラー, 再試行までの秒数)
+    # 成功なら (None, None)、権限不足・削除済みなど再試行しないものは (エラー, None)
+    async def _apply(self, member, roles, reason, attempt=0):
+        owned = {role.id for role in member.roles}
+        roles = [role for role in roles if role.id not in owned]
+        if not roles:
+            return None, None
+
+        try:
+            await member.add_roles(*roles, reason=reason)
+            return None, None
+        except discord.RateLimited as e:
+            return e, e.retry_after
+        except (discord.Forbidden, discord.NotFound) as e:
+            return e, None
+        except discord.HTTPException as e:
+            if e.status < 500 and e.status != 429:
+                return e, None
+            return e, self.retry_delay * 2**attempt
+        except (OSError, asyncio.TimeoutError) as e:
+            return e, self.retry_delay * 2**attempt
+
+    # 終了時：残っている付与を timeout 秒まで待ってから止める
+    async def close(self, timeout=10.0):
+        workers = list(self._workers.values())
+        if not workers:
+            return
+
+        done, running = await asyncio.wait(workers, timeout=timeout)
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+            print(f"未処理のロール付与 {len(self)} 件を破棄しました")
+        self._pending = {}
@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import sqlite3
+import time
+
+import numpy as np
+
+from games import (SLOT_JACKPOT, SLOT_PAIR_PAYOUT, SLOT_SYMBOLS,
+                   SLOT_TRIPLE_DEFAULT, SLOT_TRIPLE_PAYOUTS, AliasSampler,
+                   slot_multipliers)
+
+# スロット・ガチャの配当シミュレーター（オフライン）
+# ボットと同じ配当表・抽選器を使い、NumPy でまとめて回して還元率やばらつきを見る。
+# 配当やロールの確率を変える前に、経済が膨らむか縮むかを確かめるためのもの。
+#
+#   python simulate.py --spins 10000000 --seed 1
+#   python simulate.py --triple 7️⃣=20 --pair 1 --players 200 --spins-per-day 30
+#   python simulate.py --db bot_database.db --guild-id 123 --rolls 1000000
+
+CHUNK = 1_000_000  # 一度に回す回数（メモリ使用量の上限）
+
+
+# 配当表（--triple で上書きしたもの）から、シンボル番号ごとの3つ揃いの倍率を作る
+def triple_table(overrides, default):
+    payouts = dict(SLOT_TRIPLE_PAYOUTS)
+    payouts.update(overrides)
+    return np.array([payouts.get(symbol, default) for symbol in SLOT_SYMBOLS])
+
+
+# 全 8^3 通りから求めた厳密な還元率（シミュレーション結果の確認用）
+def exact_rtp(triple, pair):
+    n = len(SLOT_SYMBOLS)
+    reels = np.array(list(itertools.product(range(n), repeat=3)))
+    return slot_multipliers(reels, triple, pair).mean()
+
+
+def simulate_slots(spins, rng, triple, pair):
+    total = 0
+    total_sq = 0
+    counts = np.zeros(max(int(triple.max()), pair) + 1, dtype=np.int64)
+
+    for start in range(0, spins, CHUNK):
+        n = min(CHUNK, spins - start)
+        reels = rng.integers(0, len(SLOT_SYMBOLS), size=(n, 3), dtype=np.int8)
+        multipliers = slot_multipliers(reels, triple, pair)
+        total += int(multipliers.sum())
+        total_sq += int(np.square(multipliers, dtype=np.int64).sum())
+        counts += np.bincount(multipliers, minlength=len(counts))
+
+    mean = total / spins
+    return {
+        'rtp': mean,
+        'variance': total_sq / spins - mean * mean,
+        'hit_rate': 1 - counts[0] / spins,
+        'jackpot_rate': counts[SLOT_JACKPOT:].sum() / spins,
+        'counts': counts,
+    }
+
+
+def simulate_gacha(rolls, rng, sampler):
+    counts = np.zeros(len(sampler.items) + 1, dtype=np.int64)
+    for start in range(0, rolls, CHUNK):
+        n = min(CHUNK, rolls - start)
+        counts += np.bincount(sampler.draw_indices(n, rng),
+                              minlength=len(counts))
+    return counts
+
+
+# ロールの読み込み: --roles "name=確率,..." か、データベースの gacha_roles
+def load_roles(options):
+    if options.roles:
+        roles = []
+        for entry in options.roles.split(','):
+            name, _, probability = entry.rpartition('=')
+            roles.append((name.strip(), float(probability)))
+        return roles
+
+    if options.db:
+        conn = sqlite3.connect(options.db)
+        try:
+            return conn.execute(
+                'SELECT role_name, probability FROM gacha_roles '
+                'WHERE guild_id = ? ORDER BY id',
+                (options.guild_id, )).fetchall()
+        finally:
+            conn.close()
+    return []
+
+
+def parse_triples(text):
+    overrides = {}
+    for entry in filter(None, (text or '').split(',')):
+        symbol, _, multiplier = entry.partition('=')
+        if symbol.strip() not in SLOT_SYMBOLS:
+            raise SystemExit(f"Unknown symbol: {symbol} "
+                             f"(choose from {' '.join(SLOT_SYMBOLS)})")
+        overrides[symbol.strip()] = multiplier_arg(multiplier)
+    return overrides
+
+
+# 倍率は 0 以上（np.bincount は負の値を数えられない）
+def multiplier_arg(text):
+    try:
+        value = int(text)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise SystemExit(f"Invalid multiplier: {text} (must be an integer >= 0)")
+    return value
+
+
+def report_slots(options, rng):
+    triple = triple_table(parse_triples(options.triple), options.triple_default)
+    started = time.perf_counter()
+    result = simulate_slots(options.spins, rng, triple, options.pair)
+    elapsed = time.perf_counter() - started
+
+    bet = options.bet
+    edge = 1 - result['rtp']
+    print(f"== Slot: {options.spins:,} spins in {elapsed:.2f}s "
+          f"({options.spins / elapsed / 1e6:.1f}M spins/s)")
+    print("  payouts: " +
+          " ".join(f"{s}x{m}" for s, m in zip(SLOT_SYMBOLS, triple)) +
+          f" / pair x{options.pair}")
+    print(f"  return to player  {result['rtp']:.4%} "
+          f"(exact {exact_rtp(triple, options.pair):.4%})")
+    print(f"  house edge        {edge:+.4%}")
+    print(f"  std dev per spin  {result['variance'] ** 0.5 * bet:,.1f} coins "
+          f"(bet {bet:,})")
+    print(f"  hit rate          {result['hit_rate']:.4%}")
+    jackpot_rate = result['jackpot_rate']
+    print(f"  jackpot (x{SLOT_JACKPOT}+)    {jackpot_rate:.4%}" +
+          (f" (1 in {1 / jackpot_rate:,.0f})" if jackpot_rate else ""))
+    for multiplier, count in enumerate(result['counts']):
+        if count and multiplier:
+            print(f"    x{multiplier:<3} {count / options.spins:.4%}")
+
+    per_day = options.players * options.spins_per_day
+    if per_day:
+        flow = per_day * bet * (result['rtp'] - 1)
+        print(f"  coin flow per day {flow:+,.0f} coins "
+              f"({options.players:,} players x {options.spins_per_day:,} "
+              f"spins, + is inflation)")
+    return result
+
+
+def report_gacha(options, rng):
+    roles = load_roles(options)
+    if not roles:
+        print("== Gacha: no roles (use --roles or --db)")
+        return None
+
+    sampler = AliasSampler([name for name, _ in roles],
+                           [probability for _, probability in roles])
+    started = time.perf_counter()
+    counts = simulate_gacha(options.rolls, rng, sampler)
+    elapsed = time.perf_counter() - started
+
+    print(f"== Gacha: {options.rolls:,} rolls in {elapsed:.2f}s "
+          f"(cost {options.gacha_cost:,} per roll)")
+    print(f"  {'role':<20}{'configured':>11}{'simulated':>11}"
+          f"{'coins/role':>13}")
+    for i, (name, probability) in enumerate(roles):
+        rate = counts[i] / options.rolls
+        cost = f"{options.gacha_cost / rate:,.0f}" if rate else "-"
+        print(f"  {name[:19]:<20}{probability / 100:>11.3%}{rate:>11.3%}"
+              f"{cost:>13}")
+    print(f"  {'(miss)':<20}{sampler.miss_chance / 100:>11.3%}"
+          f"{counts[-1] / options.rolls:>11.3%}")
+
+    per_day = options.players * options.rolls_per_day
+    if per_day:
+        print(f"  coin flow per day {-per_day * options.gacha_cost:+,} coins "
+              f"({options.players:,} players x {options.rolls_per_day:,} rolls)")
+    return counts
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Slot / gacha payout simulator")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--spins', type=int, default=10_000_000)
+    parser.add_argument('--bet', type=int, default=100)
+    parser.add_argument('--triple',
+                        metavar='SYMBOL=X,...',
+                        help="override triple payouts, e.g. 7️⃣=20,💎=12")
+    parser.add_argument('--triple-default',
+                        type=multiplier_arg,
+                        default=SLOT_TRIPLE_DEFAULT)
+    parser.add_argument('--pair',
+                        type=multiplier_arg,
+                        default=SLOT_PAIR_PAYOUT)
+    parser.add_argument('--rolls', type=int, default=1_000_000)
+    parser.add_argument('--gacha-cost', type=int, default=100)
+    parser.add_argument('--roles',
+                        metavar='NAME=PERCENT,...',
+                        help="gacha roles, e.g. Gold=1,Silver=5")
+    parser.add_argument('--db', metavar='PATH', help="read gacha_roles")
+    parser.add_argument('--guild-id', type=int, default=0)
+    parser.add_argument('--players', type=int, default=0)
+    parser.add_argument('--spins-per-day', type=int, default=0)
+    parser.add_argument('--rolls-per-day', type=int, default=0)
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(options.seed)
+    if options.spins:
+        report_slots(options, rng)
+    if options.rolls:
+        report_gacha(options, rng)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,547 @@
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+try:
+    import asyncpg
+except ImportError:  # STORAGE=postgres のときだけ必要
+    asyncpg = None
+
+from database import (BalanceLedger, Database, EconomyRegistry,
+                      InsufficientBalance, PurchaseResult, RankResult,
+                      pragmas_from_env)
+
+# ストレージの切り替え（STORAGE=sqlite | memory | postgres）
+# コマンドは経済オブジェクト（database.GuildEconomy と同じメソッド）だけを使うので、
+# ここで選んだレジストリの get(guild_id) が返すものを差し替えればよい。
+#   残高:    get_balance / adjust / adjust_many / rank / top_balances.top()
+#   デイリー: claim_daily
+#   商品:    list_items / add_item / remove_item / purchase
+#   ガチャ:  list_gacha_roles / add_gacha_role / remove_gacha_role
+# sqlite は従来どおり（レジャー・定期ジョブ・ギルドごとのファイルが使える）。
+# memory はプロセス内の dict だけで動く（テスト・ベンチマーク用、終了すると消える）。
+# postgres は asyncpg の接続プールを使い、各操作を1文（購入・一括増減はトランザクション）で行う。
+
+DEFAULT_BALANCE = 1000
+TOP_SIZE = 10
+
+
+# 環境変数からレジストリを作る（observer は計測用 observer(kind, seconds)）
+def storage_from_env(environ, observer=None):
+    kind = environ.get('STORAGE', 'sqlite').lower()
+    if kind == 'memory':
+        return MemoryEconomyRegistry()
+    if kind == 'postgres':
+        registry = PostgresEconomyRegistry(
+            environ.get('DATABASE_URL', 'postgresql://localhost/bot'),
+            min_size=int(environ.get('PG_POOL_MIN', '2')),
+            max_size=int(environ.get('PG_POOL_MAX', '10')))
+        registry.observer = observer
+        return registry
+    if kind != 'sqlite':
+        raise ValueError(f"unknown STORAGE: {kind}")
+
+    # DB_PROFILE (safe / balanced / fast) と DB_SYNCHRONOUS などの個別設定は .env で指定できる
+    db = Database('bot_database.db',
+                  pragmas=pragmas_from_env(environ),
+                  checkpoint_interval=float(
+                      environ.get('DB_CHECKPOINT_INTERVAL', '300')))
+    db.observer = observer
+    # 残高はメモリ上で即時反映し、まとめてコミットする（LEDGER_MAX_PENDING=0 で毎回コミット）
+    ledger = BalanceLedger(
+        db,
+        default_balance=DEFAULT_BALANCE,
+        flush_interval=float(environ.get('LEDGER_FLUSH_INTERVAL', '1.0')),
+        max_pending=int(environ.get('LEDGER_MAX_PENDING', '500')))
+    # DB_GUILD_PATH（例: bot_database.{guild_id}.db）を指定するとギルドごとに別ファイルにする
+    return EconomyRegistry(db,
+                           ledger,
+                           guild_path=environ.get('DB_GUILD_PATH') or None,
+                           guild_readers=int(
+                               environ.get('DB_GUILD_READERS', '1')))
+
+
+# 同額は同順位、並びは (-balance, user_id) 順（RankIndex と同じ）
+def _rank(balances, user_id, balance):
+    higher = 0
+    above = below = None
+    key = (-balance, user_id)
+    for other, other_balance in balances.items():
+        if other_balance > balance:
+            higher += 1
+        if other == user_id:
+            continue
+        other_key = (-other_balance, other)
+        if other_key < key:
+            if above is None or other_key > above:
+                above = other_key
+        elif below is None or other_key < below:
+            below = other_key
+
+    total = len(balances) + (user_id not in balances)
+    return RankResult(higher + 1, total, balance,
+                      (above[1], -above[0]) if above else None,
+                      (below[1], -below[0]) if below else None)
+
+
+class _MemoryTopBalances:
+
+    def __init__(self, balances, size):
+        self.balances = balances
+        self.size = size
+
+    # 残高が 0 のユーザーは載せない（TopBalances と同じ）
+    async def top(self):
+        return heapq.nsmallest(
+            self.size,
+            ((user_id, balance)
+             for user_id, balance in self.balances.items() if balance > 0),
+            key=lambda entry: (-entry[1], entry[0]))
+
+
+class MemoryEconomy:
+
+    def __init__(self, guild_id, registry):
+        self.guild_id = guild_id
+        self.registry = registry
+        self.balances = {}  # user_id -> 残高
+        self.daily = {}  # user_id -> (daily_day, streak)
+        self.items = {}  # id -> [name, price, description, stock, restock_to]
+        self.roles = {}  # role_id -> (role_name, probability, description)
+        self.top_balances = _MemoryTopBalances(self.balances, TOP_SIZE)
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+    async def get_balance(self, user_id):
+        return self.balances.get(user_id, self.registry.default_balance)
+
+    async def adjust(self, user_id, delta, required=None):
+        if required is None:
+            required = max(0, -delta)
+        balance = await self.get_balance(user_id)
+        if balance < required:
+            return None
+        self.balances[user_id] = balance + delta
+        return balance + delta
+
+    async def adjust_many(self, deltas, progress=None):
+        applied = {}
+        for user_id, delta in deltas.items():
+            balance = self.balances.get(user_id,
+                                        self.registry.default_balance)
+            delta = max(delta, -balance)
+            applied[user_id] = delta
+            self.balances[user_id] = balance + delta
+        return applied
+
+    async def purchase(self, user_id, item_id, quantity=1):
+        item = self.items.get(item_id)
+        if item is None:
+            return PurchaseResult('not_found', None, None, None, None)
+
+        name, price, _, stock, _ = item
+        if stock != -1 and stock < quantity:
+            return PurchaseResult('out_of_stock', name, price, stock, None)
+
+        balance = await self.adjust(user_id, -price * quantity)
+        if balance is None:
+            return PurchaseResult('insufficient', name, price, None,
+                                  await self.get_balance(user_id))
+        if stock != -1:
+            item[3] = stock = stock - quantity
+        return PurchaseResult('ok', name, price, stock, balance)
+
+    async def rank(self, user_id):
+        return _rank(self.balances, user_id, await self.get_balance(user_id))
+
+    async def claim_daily(self, user_id, day, amount, streak_bonus, streak_max):
+        last_day, streak = self.daily.get(user_id, (None, 0))
+        if last_day is not None and last_day >= day:
+            return None
+
+        streak = streak if last_day == day - 1 else 0
+        bonus = amount + streak_bonus * min(streak, streak_max)
+        self.daily[user_id] = (day, streak + 1)
+        balance = await self.adjust(user_id, bonus)
+        return balance, bonus, streak + 1
+
+    async def list_items(self):
+        return [(item_id, name, price, description, stock)
+                for item_id, (name, price, description, stock,
+                              _) in sorted(self.items.items())]
+
+    async def add_item(self, name, price, description, stock=-1,
+                       restock_to=None):
+        item_id = next(self.registry.item_ids)
+        self.items[item_id] = [name, price, description, stock, restock_to]
+        self.shop_pages = None
+
+    async def remove_item(self, item_id):
+        item = self.items.pop(item_id, None)
+        self.shop_pages = None
+        return item[0] if item else None
+
+    async def list_gacha_roles(self):
+        return [(role_id, *role) for role_id, role in self.roles.items()]
+
+    async def add_gacha_role(self, role_id, role_name, probability,
+                             description):
+        if role_id in self.roles:
+            return False
+        self.roles[role_id] = (role_name, probability, description)
+        self.gacha_sampler = None
+        return True
+
+    async def remove_gacha_role(self, role_id):
+        role = self.roles.pop(role_id, None)
+        self.gacha_sampler = None
+        return role[0] if role else None
+
+    def invalidate(self):
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+
+class MemoryEconomyRegistry:
+
+    def __init__(self, default_balance=DEFAULT_BALANCE):
+        self.default_balance = default_balance
+        self.item_ids = itertools.count(1)  # 商品 ID はギルドをまたいで通し番号
+        self._economies = {}
+
+    def __iter__(self):
+        return iter(self._economies.values())
+
+    async def start(self):
+        pass
+
+    async def get(self, guild_id):
+        economy = self._economies.get(guild_id)
+        if economy is None:
+            economy = self._economies[guild_id] = MemoryEconomy(
+                guild_id, self)
+        return economy
+
+    async def close(self):
+        self._economies = {}
+
+
+POSTGRES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS user_money (
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        balance BIGINT NOT NULL,
+        daily_day INTEGER,
+        streak INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_money_guild_balance
+        ON user_money (guild_id, balance DESC, user_id);
+    CREATE TABLE IF NOT EXISTS shop_items (
+        id BIGSERIAL PRIMARY KEY,
+        guild_id BIGINT NOT NULL,
+        name TEXT NOT NULL,
+        price BIGINT NOT NULL,
+        description TEXT,
+        stock INTEGER NOT NULL DEFAULT -1,
+        restock_to INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_shop_items_guild ON shop_items (guild_id, id);
+    CREATE TABLE IF NOT EXISTS gacha_roles (
+        id BIGSERIAL PRIMARY KEY,
+        guild_id BIGINT NOT NULL,
+        role_id BIGINT NOT NULL,
+        role_name TEXT NOT NULL,
+        probability DOUBLE PRECISION NOT NULL,
+        description TEXT,
+        UNIQUE (guild_id, role_id)
+    );
+'''
+
+# database.ADJUST_BALANCE_SQL と同じ（残高が $5 以上のときだけ更新、初回は行を作成）
+PG_ADJUST_BALANCE_SQL = '''
+    INSERT INTO user_money AS m (guild_id, user_id, balance)
+    SELECT $1, $2, $3::bigint + $4::bigint WHERE $3::bigint >= $5::bigint
+        OR EXISTS (SELECT 1 FROM user_money WHERE guild_id = $1 AND user_id = $2)
+    ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = m.balance + $4
+    WHERE m.balance >= $5
+    RETURNING balance
+'''
+
+PG_BUY_ITEM_SQL = '''
+    UPDATE shop_items
+    SET stock = CASE WHEN stock = -1 THEN -1 ELSE stock - $3 END
+    WHERE guild_id = $1 AND id = $2 AND (stock = -1 OR stock >= $3)
+    RETURNING name, price, stock
+'''
+
+# database.CLAIM_DAILY_SQL と同じ（$4 は今日の date.toordinal()）
+PG_CLAIM_DAILY_SQL = '''
+    INSERT INTO user_money AS m (guild_id, user_id, balance, daily_day, streak)
+    VALUES ($1, $2, $3::bigint + $5::bigint, $4::integer, 1)
+    ON CONFLICT (guild_id, user_id) DO UPDATE SET
+        balance = m.balance + $5 + $6 * LEAST(
+            CASE WHEN m.daily_day = $4 - 1 THEN m.streak ELSE 0 END, $7),
+        streak = CASE WHEN m.daily_day = $4 - 1 THEN m.streak + 1 ELSE 1 END,
+        daily_day = $4
+    WHERE m.daily_day IS NULL OR m.daily_day < $4
+    RETURNING balance, streak
+'''
+
+# 自分より残高が多い人数・全体の人数と、並び順で前後のユーザー
+PG_RANK_SQL = '''
+    SELECT
+        (SELECT count(*) FROM user_money
+         WHERE guild_id = $1 AND balance > $2),
+        (SELECT count(*) FROM user_money WHERE guild_id = $1),
+        EXISTS (SELECT 1 FROM user_money WHERE guild_id = $1 AND user_id = $3),
+        (SELECT ARRAY[user_id, balance] FROM user_money
+         WHERE guild_id = $1
+           AND (balance > $2 OR (balance = $2 AND user_id < $3))
+         ORDER BY balance, user_id DESC LIMIT 1),
+        (SELECT ARRAY[user_id, balance] FROM user_money
+         WHERE guild_id = $1
+           AND (balance < $2 OR (balance = $2 AND user_id > $3))
+         ORDER BY balance DESC, user_id LIMIT 1)
+'''
+
+
+class _PostgresTopBalances:
+
+    def __init__(self, economy, size):
+        self.economy = economy
+        self.size = size
+
+    async def top(self):
+        rows = await self.economy.registry.query(
+            'read', 'fetch', 'SELECT user_id, balance FROM user_money '
+            'WHERE guild_id = $1 AND balance > 0 '
+            'ORDER BY balance DESC, user_id LIMIT $2',
+            self.economy.guild_id, self.size)
+        return [tuple(row) for row in rows]
+
+
+class PostgresEconomy:
+
+    def __init__(self, guild_id, registry):
+        self.guild_id = guild_id
+        self.registry = registry
+        self.top_balances = _PostgresTopBalances(self, TOP_SIZE)
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+    async def get_balance(self, user_id):
+        balance = await self.registry.query(
+            'read', 'fetchval', 'SELECT balance FROM user_money '
+            'WHERE guild_id = $1 AND user_id = $2', self.guild_id, user_id)
+        return self.registry.default_balance if balance is None else balance
+
+    async def adjust(self, user_id, delta, required=None):
+        if required is None:
+            required = max(0, -delta)
+        return await self.registry.query('write', 'fetchval',
+                                         PG_ADJUST_BALANCE_SQL, self.guild_id,
+                                         user_id,
+                                         self.registry.default_balance, delta,
+                                         required)
+
+    # 1トランザクションの中で 500 人ずつ、行を作ってロックし、残高を 0 で止めた値に書き換える
+    # （途中で失敗しても一部だけ反映されることはない）。
+    # 同時に実行された一括入出金がデッドロックしないよう、行は user_id 順にロックする
+    async def adjust_many(self, deltas, progress=None, chunk_size=500):
+        user_ids = sorted(deltas)
+        applied = {}
+        async with self.registry.transaction() as conn:
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i:i + chunk_size]
+                await conn.execute(
+                    'INSERT INTO user_money (guild_id, user_id, balance) '
+                    'SELECT $1, unnest($2::bigint[]), $3 '
+                    'ON CONFLICT DO NOTHING', self.guild_id, chunk,
+                    self.registry.default_balance)
+                rows = await conn.fetch(
+                    'SELECT user_id, balance FROM user_money '
+                    'WHERE guild_id = $1 AND user_id = ANY($2::bigint[]) '
+                    'ORDER BY user_id FOR UPDATE', self.guild_id, chunk)
+                balances = []
+                for user_id, balance in rows:
+                    delta = max(deltas[user_id], -balance)
+                    applied[user_id] = delta
+                    balances.append(balance + delta)
+                await conn.execute(
+                    'UPDATE user_money m SET balance = t.balance '
+                    'FROM unnest($2::bigint[], $3::bigint[]) '
+                    'AS t(user_id, balance) '
+                    'WHERE m.guild_id = $1 AND m.user_id = t.user_id',
+                    self.guild_id, [row[0] for row in rows], balances)
+                if progress is not None:
+                    await progress(i + len(chunk), len(user_ids))
+        return applied
+
+    # 在庫の減算と残高の引き落としを1トランザクションで行う
+    async def purchase(self, user_id, item_id, quantity=1):
+        try:
+            async with self.registry.transaction() as conn:
+                item = await conn.fetchrow(PG_BUY_ITEM_SQL, self.guild_id,
+                                           item_id, quantity)
+                if item is None:
+                    row = await conn.fetchrow(
+                        'SELECT name, price, stock FROM shop_items '
+                        'WHERE guild_id = $1 AND id = $2', self.guild_id,
+                        item_id)
+                    if row is None:
+                        return PurchaseResult('not_found', None, None, None,
+                                              None)
+                    return PurchaseResult('out_of_stock', *row, None)
+
+                name, price, stock = item
+                cost = price * quantity
+                balance = await conn.fetchval(PG_ADJUST_BALANCE_SQL,
+                                              self.guild_id, user_id,
+                                              self.registry.default_balance,
+                                              -cost, cost)
+                if balance is None:
+                    raise InsufficientBalance()  # 在庫の減算も取り消す
+        except InsufficientBalance:
+            return PurchaseResult('insufficient', name, price, None,
+                                  await self.get_balance(user_id))
+        return PurchaseResult('ok', name, price, stock, balance)
+
+    async def rank(self, user_id):
+        balance = await self.get_balance(user_id)
+        higher, total, exists, above, below = await self.registry.query(
+            'read', 'fetchrow', PG_RANK_SQL, self.guild_id, balance, user_id)
+        return RankResult(higher + 1, total + (not exists), balance,
+                          tuple(above) if above else None,
+                          tuple(below) if below else None)
+
+    async def claim_daily(self, user_id, day, amount, streak_bonus, streak_max):
+        row = await self.registry.query('write', 'fetchrow',
+                                        PG_CLAIM_DAILY_SQL, self.guild_id,
+                                        user_id,
+                                        self.registry.default_balance, day,
+                                        amount, streak_bonus, streak_max)
+        if row is None:
+            return None
+
+        balance, streak = row
+        return balance, amount + streak_bonus * min(streak - 1,
+                                                    streak_max), streak
+
+    async def list_items(self):
+        rows = await self.registry.query(
+            'read', 'fetch',
+            'SELECT id, name, price, description, stock FROM shop_items '
+            'WHERE guild_id = $1 ORDER BY id', self.guild_id)
+        return [tuple(row) for row in rows]
+
+    async def add_item(self, name, price, description, stock=-1,
+                       restock_to=None):
+        await self.registry.query(
+            'write', 'execute',
+            'INSERT INTO shop_items (guild_id, name, price, description, '
+            'stock, restock_to) VALUES ($1, $2, $3, $4, $5, $6)',
+            self.guild_id, name, price, description, stock, restock_to)
+        self.shop_pages = None
+
+    async def remove_item(self, item_id):
+        name = await self.registry.query(
+            'write', 'fetchval', 'DELETE FROM shop_items '
+            'WHERE guild_id = $1 AND id = $2 RETURNING name', self.guild_id,
+            item_id)
+        self.shop_pages = None
+        return name
+
+    async def list_gacha_roles(self):
+        rows = await self.registry.query(
+            'read', 'fetch',
+            'SELECT role_id, role_name, probability, description '
+            'FROM gacha_roles WHERE guild_id = $1 ORDER BY id', self.guild_id)
+        return [tuple(row) for row in rows]
+
+    async def add_gacha_role(self, role_id, role_name, probability,
+                             description):
+        added = await self.registry.query(
+            'write', 'fetchval',
+            'INSERT INTO gacha_roles (guild_id, role_id, role_name, '
+            'probability, description) VALUES ($1, $2, $3, $4, $5) '
+            'ON CONFLICT (guild_id, role_id) DO NOTHING RETURNING id',
+            self.guild_id, role_id, role_name, probability, description)
+        self.gacha_sampler = None
+        return added is not None
+
+    async def remove_gacha_role(self, role_id):
+        name = await self.registry.query(
+            'write', 'fetchval', 'DELETE FROM gacha_roles '
+            'WHERE guild_id = $1 AND role_id = $2 RETURNING role_name',
+            self.guild_id, role_id)
+        self.gacha_sampler = None
+        return name
+
+    def invalidate(self):
+        self.gacha_sampler = None
+        self.shop_pages = None
+
+
+class PostgresEconomyRegistry:
+
+    def __init__(self,
+                 dsn,
+                 min_size=2,
+                 max_size=10,
+                 default_balance=DEFAULT_BALANCE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.default_balance = default_balance
+        self.pool = None
+        self.observer = None  # 計測用 observer(kind, seconds)
+        self._economies = {}
+
+    def __iter__(self):
+        return iter(self._economies.values())
+
+    async def start(self):
+        if asyncpg is None:
+            raise RuntimeError("STORAGE=postgres には asyncpg が必要です"
+                               "（pip install asyncpg）")
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(self.dsn,
+                                              min_size=self.min_size,
+                                              max_size=self.max_size)
+        await self.pool.execute(POSTGRES_SCHEMA)
+
+    async def get(self, guild_id):
+        economy = self._economies.get(guild_id)
+        if economy is None:
+            economy = self._economies[guild_id] = PostgresEconomy(
+                guild_id, self)
+        return economy
+
+    # プールの接続で1文実行する（method は fetch / fetchrow / fetchval / execute）
+    async def query(self, kind, method, sql, *args):
+        started = time.perf_counter()
+        try:
+            return await getattr(self.pool, method)(sql, *args)
+        finally:
+            if self.observer is not None:
+                self.observer(kind, time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def transaction(self):
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    yield conn
+        finally:
+            if self.observer is not None:
+                self.observer('write', time.perf_counter() - started)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        self._economies = {}
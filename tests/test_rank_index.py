@@ -0,0 +1,65 @@
+import asyncio
+import random
+
+from database import BalanceLedger, Database, RankIndex
+
+# RankIndex（/rank の順位表）を総当たりの順位と比べる
+# load を小さくして、リストの分割・空になったリストの削除・リストをまたぐ前後の検索を通す
+
+GUILD_ID = 7
+DEFAULT_BALANCE = 1000
+
+
+# 総当たり: 残高の多い順（同額は user_id 順）に並べて、順位と前後のユーザーを求める
+def brute_force(balances, user_id, balance):
+    others = [(-b, u) for u, b in balances.items() if u != user_id]
+    higher = sum(1 for b, _ in others if -b > balance)
+    key = (-balance, user_id)
+    above = max((k for k in others if k < key), default=None)
+    below = min((k for k in others if k > key), default=None)
+    return (higher + 1, len(others) + 1, balance,
+            (above[1], -above[0]) if above else None,
+            (below[1], -below[0]) if below else None)
+
+
+async def check_rank_index(path, seed):
+    rng = random.Random(seed)
+    db = Database(path)
+    await db.start()
+    await db.migrate()
+    ledger = BalanceLedger(db, default_balance=DEFAULT_BALANCE)
+    await ledger.start()
+    index = RankIndex(ledger, GUILD_ID, load=3)
+    balances = {}
+    try:
+        # 読み込み前からある行
+        for user_id in range(20):
+            balances[user_id] = await ledger.adjust(
+                GUILD_ID, user_id, rng.randrange(-9, 10) * 100)
+        await ledger.flush()
+
+        for step in range(2000):
+            user_id = rng.randrange(60)
+            kind = rng.randrange(10)
+            if kind < 6:
+                # 同額が多くなるよう 100 単位で増減する（足りない減算は何もしない）
+                delta = rng.randrange(-15, 15) * 100
+                balance = await ledger.adjust(GUILD_ID, user_id, delta)
+                if balance is not None:
+                    balances[user_id] = balance
+            elif kind == 6 and step % 7 == 0:
+                # ときどき DB から読み直す（未コミットの差分が書かれているかも確かめる）
+                index.invalidate()
+            else:
+                balance = balances.get(user_id, DEFAULT_BALANCE)
+                result = await index.around(user_id, balance)
+                assert tuple(result) == brute_force(balances, user_id,
+                                                    balance), step
+    finally:
+        await ledger.close()
+        await db.close()
+
+
+def test_rank_index_matches_brute_force(tmp_path):
+    for seed in range(3):
+        asyncio.run(check_rank_index(str(tmp_path / f'rank{seed}.db'), seed))
@@ -0,0 +1,178 @@
+import asyncio
+
+import discord
+
+from roles import RoleGrantQueue
+
+# RoleGrantQueue の確認（Discord には接続せず、失敗を起こせる偽のメンバーを使う）
+
+
+class FakeResponse:
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'fake'
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id=1):
+        self.id = guild_id
+
+
+class FakeRole:
+
+    def __init__(self, role_id):
+        self.id = role_id
+
+
+# add_roles が errors の例外を順に投げ、尽きたら成功する
+class FakeMember:
+
+    def __init__(self, member_id, guild, errors=(), delay=0.0):
+        self.id = member_id
+        self.guild = guild
+        self.roles = []
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = []
+
+    async def add_roles(self, *roles, reason=None):
+        self.calls.append(sorted(role.id for role in roles))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.roles.extend(roles)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_merges_pending_grants_for_one_member():
+
+    async def check():
+        queue = RoleGrantQueue(retry_delay=0.01)
+        guild = FakeGuild()
+        busy = FakeMember(1, guild, delay=0.05)
+        member = FakeMember(2, guild)
+        futures = [
+            queue.grant(busy, [FakeRole(10)]),
+            queue.grant(member, [FakeRole(20)]),
+            queue.grant(member, [FakeRole(21)]),
+            queue.grant(member, [FakeRole(20)]),
+        ]
+        assert await asyncio.gather(*futures) == [None] * 4
+        assert member.calls == [[20, 21]]
+        assert len(queue) == 0
+
+    run(check())
+
+
+def test_retries_server_errors_with_backoff():
+
+    async def check():
+        queue = RoleGrantQueue(max_retries=3, retry_delay=0.05)
+        member = FakeMember(1,
+                            FakeGuild(),
+                            errors=[
+                                discord.HTTPException(FakeResponse(503), 'x'),
+                                discord.HTTPException(FakeResponse(500), 'x'),
+                            ])
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await queue.grant(member, [FakeRole(10)]) is None
+        # 0.05 + 0.1 秒待ってから3回目で成功する
+        assert loop.time() - started >= 0.15
+        assert len(member.calls) == 3
+        assert [role.id for role in member.roles] == [10]
+
+    run(check())
+
+
+def test_retries_rate_limits_and_gives_up_after_max_retries():
+
+    async def check():
+        queue = RoleGrantQueue(max_retries=2, retry_delay=0.01)
+        limited = FakeMember(1,
+                             FakeGuild(),
+                             errors=[discord.RateLimited(0.02)])
+        assert await queue.grant(limited, [FakeRole(10)]) is None
+        assert len(limited.calls) == 2
+
+        failing = FakeMember(2,
+                             FakeGuild(),
+                             errors=[
+                                 discord.HTTPException(FakeResponse(502), 'x')
+                                 for _ in range(5)
+                             ])
+        error = await queue.grant(failing, [FakeRole(10)])
+        assert isinstance(error, discord.HTTPException)
+        assert len(failing.calls) == 3
+
+    run(check())
+
+
+def test_gives_up_on_forbidden_and_not_found():
+
+    async def check():
+        queue = RoleGrantQueue(retry_delay=0.01)
+        for error_type in (discord.Forbidden, discord.NotFound):
+            member = FakeMember(1,
+                                FakeGuild(),
+                                errors=[error_type(FakeResponse(403), 'x')])
+            error = await queue.grant(member, [FakeRole(10)])
+            assert isinstance(error, error_type)
+            assert len(member.calls) == 1
+
+        # 500 未満の HTTP エラーも再試行しない
+        member = FakeMember(2,
+                            FakeGuild(),
+                            errors=[discord.HTTPException(FakeResponse(400), 'x')])
+        assert isinstance(await queue.grant(member, [FakeRole(10)]),
+                          discord.HTTPException)
+        assert len(member.calls) == 1
+
+    run(check())
+
+
+def test_retrying_member_does_not_block_the_guild():
+
+    async def check():
+        queue = RoleGrantQueue(max_retries=1, retry_delay=0.2)
+        guild = FakeGuild()
+        failing = FakeMember(1,
+                             guild,
+                             errors=[discord.HTTPException(FakeResponse(503), 'x')])
+        member = FakeMember(2, guild)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = queue.grant(failing, [FakeRole(10)])
+        assert await queue.grant(member, [FakeRole(20)]) is None
+        assert loop.time() - started < 0.1
+        assert await first is None
+
+    run(check())
+
+
+def test_close_drains_the_queue():
+
+    async def check():
+        queue = RoleGrantQueue(retry_delay=0.01)
+        guild = FakeGuild()
+        members = [FakeMember(i, guild, delay=0.01) for i in range(5)]
+        futures = [queue.grant(member, [FakeRole(10)]) for member in members]
+        await queue.close()
+        assert all(future.done() for future in futures)
+        assert all(member.roles for member in members)
+        assert len(queue) == 0
+
+        # timeout を過ぎたぶんは破棄する
+        slow = FakeMember(9, guild, delay=1.0)
+        queue.grant(slow, [FakeRole(10)])
+        await queue.close(timeout=0.05)
+        assert len(queue) == 0
+        assert not slow.roles
+
+    run(check())
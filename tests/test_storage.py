@@ -0,0 +1,169 @@
+import asyncio
+import os
+import random
+import uuid
+
+import pytest
+
+from storage import PostgresEconomyRegistry, asyncpg, storage_from_env
+
+# ストレージの互換性の確認
+# 同じ操作列を memory / sqlite / postgres で実行し、結果が memory と同じになることを確かめる。
+# postgres は DATABASE_URL があるときだけ。使い捨てのスキーマに作るので既存の表には触れない。
+
+STEPS = 600
+
+
+async def run_ops(registry, seed):
+    rng = random.Random(seed)
+    economy = await registry.get(7)
+    out = []
+
+    await economy.add_item('A', 50, 'a', -1, None)
+    await economy.add_item('B', 30, 'b', 3, 3)
+    out.append(await economy.list_items())
+    out.append((await economy.add_gacha_role(11, 'Gold', 1.5, 'g'),
+                await economy.add_gacha_role(11, 'Gold', 1.5, 'g'),
+                await economy.add_gacha_role(12, 'Silver', 5.0, '')))
+    out.append(await economy.list_gacha_roles())
+
+    for step in range(STEPS):
+        user_id = rng.randrange(30)
+        kind = rng.randrange(7)
+        if kind == 0:
+            result = await economy.adjust(user_id, rng.randrange(-1500, 1500))
+        elif kind == 1:
+            result = tuple(await economy.purchase(user_id,
+                                                  rng.choice([1, 2, 99]),
+                                                  rng.randrange(1, 3)))
+        elif kind == 2:
+            result = await economy.claim_daily(user_id, 700000 + step // 60,
+                                               500, 100, 7)
+        elif kind == 3:
+            result = tuple(await economy.rank(user_id))
+        elif kind == 4:
+            result = top_without_ties(await economy.top_balances.top())
+        elif kind == 5:
+            deltas = {
+                target: rng.randrange(-3000, 500)
+                for target in rng.sample(range(40), 5)
+            }
+            result = sorted((await economy.adjust_many(deltas)).items())
+        else:
+            result = await economy.get_balance(user_id)
+        out.append((kind, result))
+
+    out.append((await economy.remove_item(2), await economy.remove_item(2),
+                await economy.remove_gacha_role(11),
+                await economy.remove_gacha_role(11)))
+    out.append((await economy.list_items(), await economy.list_gacha_roles()))
+    return out
+
+
+# 上位の最下位と同額のユーザーはどれが入るか決まっていないので比べない
+def top_without_ties(top):
+    top = sorted(top, key=lambda entry: (-entry[1], entry[0]))
+    if not top:
+        return top
+    return [entry for entry in top if entry[1] > top[-1][1]]
+
+
+async def collect(registry, seed=3):
+    await registry.start()
+    try:
+        return await run_ops(registry, seed)
+    finally:
+        await registry.close()
+
+
+def assert_same(expected, actual):
+    for step, (a, b) in enumerate(zip(expected, actual)):
+        assert a == b, f"step {step}: {a!r} != {b!r}"
+    assert len(expected) == len(actual)
+
+
+def memory_results():
+    return asyncio.run(collect(storage_from_env({'STORAGE': 'memory'})))
+
+
+def test_sqlite_matches_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    expected = memory_results()
+    # 書き込みをまとめる経路も通るよう、フラッシュの上限を小さくする
+    actual = asyncio.run(
+        collect(
+            storage_from_env({
+                'STORAGE': 'sqlite',
+                'LEDGER_MAX_PENDING': '50'
+            })))
+    assert_same(expected, actual)
+
+
+needs_postgres = pytest.mark.skipif(
+    not os.environ.get('DATABASE_URL') or asyncpg is None,
+    reason="DATABASE_URL is not set or asyncpg is not installed")
+
+
+# 使い捨てのスキーマを作り、そこを使うレジストリで check(registry) を実行する
+async def with_postgres(check):
+    url = os.environ['DATABASE_URL']
+    schema = f'parity_{uuid.uuid4().hex[:12]}'
+    conn = await asyncpg.connect(url)
+    await conn.execute(f'CREATE SCHEMA {schema}')
+    try:
+        # クエリ文字列の残りは asyncpg が server_settings として渡す
+        separator = '&' if '?' in url else '?'
+        return await check(
+            PostgresEconomyRegistry(f'{url}{separator}search_path={schema}',
+                                    min_size=1,
+                                    max_size=4))
+    finally:
+        await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+        await conn.close()
+
+
+@needs_postgres
+def test_postgres_matches_memory():
+    expected = memory_results()
+    assert_same(expected, asyncio.run(with_postgres(collect)))
+
+
+class Abort(Exception):
+    pass
+
+
+# 一括入出金が途中で失敗したら、誰の残高も変わらない
+async def check_adjust_many_is_atomic(registry):
+    await registry.start()
+    try:
+        economy = await registry.get(7)
+        await economy.adjust(1, 500)
+
+        async def progress(done, total):
+            raise Abort()
+
+        deltas = {user_id: 100 for user_id in range(1, 1201)}
+        with pytest.raises(Abort):
+            await economy.adjust_many(deltas, progress)
+        assert await economy.get_balance(1) == 1500
+        assert await economy.get_balance(1200) == 1000
+
+        # 重なるユーザーへの一括入出金を同時に実行してもデッドロックしない
+        await asyncio.gather(
+            economy.adjust_many({user_id: 1 for user_id in range(1, 1201)}),
+            economy.adjust_many(
+                {user_id: 2 for user_id in reversed(range(1, 1201))}))
+        assert await economy.get_balance(1) == 1503
+        assert await economy.get_balance(1200) == 1003
+    finally:
+        await registry.close()
+
+
+def test_sqlite_adjust_many_is_atomic(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    asyncio.run(check_adjust_many_is_atomic(storage_from_env({})))
+
+
+@needs_postgres
+def test_postgres_adjust_many_is_atomic():
+    asyncio.run(with_postgres(check_adjust_many_is_atomic))
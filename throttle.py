@@ -0,0 +1,111 @@
+import time
+
+# コマンドの連打制限（トークンバケット）
+# バケットは (残りトークン, 最終更新時刻) のタプルだけを dict に持つ。
+# 満タンまで回復したバケットは存在しないのと同じなので、定期的にまとめて捨てる。
+
+# コマンドごとの既定の上限: (ユーザー単位, サーバー単位)、各 (回数, 秒) または None
+DEFAULT_LIMITS = {
+    'slot': ((5, 10), (100, 10)),
+    'gacha': ((3, 10), (50, 10)),
+    'buy': ((5, 10), (50, 10)),
+    'daily': ((3, 60), None),
+    'balance': ((5, 10), None),
+    'shop': ((3, 10), (30, 10)),
+    'gachalist': ((3, 10), (30, 10)),
+    'leaderboard': ((3, 30), (20, 30)),
+    'rank': ((3, 10), (30, 10)),
+}
+
+
+def _parse_limit(text):
+    text = text.strip()
+    if not text or text.lower() == 'none':
+        return None
+    count, seconds = text.split('/')
+    return int(count), float(seconds)
+
+
+# 環境変数から上限を作る
+# THROTTLE_SLOT=5/10,100/10 のように「ユーザー単位,サーバー単位」で上書きできる（none で無制限）
+# THROTTLE=off で全体を無効にする
+def limits_from_env(environ, defaults=DEFAULT_LIMITS):
+    if environ.get('THROTTLE', '').lower() in ('0', 'off', 'false'):
+        return {}
+
+    limits = dict(defaults)
+    for name in list(limits):
+        value = environ.get(f'THROTTLE_{name.upper()}')
+        if value:
+            user, _, guild = value.partition(',')
+            limits[name] = (_parse_limit(user), _parse_limit(guild))
+    return limits
+
+
+class RateLimiter:
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self._buckets = {}
+        self._next_sweep = 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # 1回ぶん消費する。使えれば 0、使えなければ次に使えるまでの秒数を返す
+    def hit(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens = min(self.capacity,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    # 満タンまで回復したバケットを捨てる
+    def _sweep(self, now):
+        capacity, rate = self.capacity, self.rate
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * rate < capacity
+        }
+        self._next_sweep = now + self.period
+
+
+class Throttle:
+
+    def __init__(self, limits):
+        self._limiters = {}
+        for name, (user, guild) in limits.items():
+            self._limiters[name] = (RateLimiter(*user) if user else None,
+                                    RateLimiter(*guild) if guild else None)
+
+    # 使えれば 0、制限中なら待ち時間（秒）を返す
+    def check(self, command, user_id, guild_id):
+        limiters = self._limiters.get(command)
+        if limiters is None:
+            return 0.0
+
+        user, guild = limiters
+        now = time.monotonic()
+        if user is not None:
+            retry_after = user.hit((guild_id, user_id), now)
+            if retry_after:
+                return retry_after
+        if guild is not None:
+            return guild.hit(guild_id, now)
+        return 0.0
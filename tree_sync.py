@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+import discord
+
+# スラッシュコマンドの同期を必要なときだけ行う
+# コマンドツリーを Discord に送る形（to_dict）にしてハッシュを取り、前回同期したときの値と
+# 同じなら tree.sync() を呼ばない。グローバル同期は遅くレート制限もきついので、
+# 再起動・再接続のたびに同期すると使えるようになるまでが遅れる。
+# 前回の値はアプリケーション・同期先（global かサーバー ID）ごとに JSON ファイルへ保存する。
+
+
+# 同期先 guild（None ならグローバル）に送られるコマンドのハッシュ
+def command_tree_hash(tree, guild=None):
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command['type'], command['name']))
+    text = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class TreeSync:
+
+    def __init__(self, tree, path, guild_ids=(), mode='auto'):
+        self.tree = tree
+        self.path = path
+        # 開発用: ここにサーバー ID があればグローバルではなくそのサーバーだけに同期する（即時反映）
+        self.guild_ids = list(guild_ids)
+        self.mode = mode  # auto（変更時のみ）、always、off
+        self.synced = False  # このプロセスで同期済みか（再接続では何もしない）
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"コマンド同期の記録を読めませんでした: {e}")
+            return {}
+
+    def _save(self, state):
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(temp, self.path)
+
+    # 同期したコマンド数（同期しなかった同期先は数えない）を返す
+    async def sync(self, application_id):
+        if self.mode == 'off' or self.synced:
+            return 0
+
+        state = self._load()
+        targets = [discord.Object(id=guild_id) for guild_id in self.guild_ids]
+        synced = 0
+        for guild in targets or [None]:
+            if guild is not None:
+                self.tree.copy_global_to(guild=guild)
+            key = f"{application_id}:{guild.id if guild else 'global'}"
+            digest = command_tree_hash(self.tree, guild)
+            if self.mode != 'always' and state.get(key) == digest:
+                print(f"スラッシュコマンドに変更がないので同期を省略しました（{key}）")
+                continue
+
+            commands = await self.tree.sync(guild=guild)
+            synced += len(commands)
+            state[key] = digest
+            self._save(state)
+            print(f"{len(commands)} 個のスラッシュコマンドを同期しました（{key}）")
+
+        self.synced = True
+        return synced
+
+
+# 環境変数から作る
+# COMMAND_SYNC=auto|always|off、COMMAND_SYNC_FILE=記録ファイル、
+# SYNC_GUILD_IDS=123,456（開発用サーバー）
+def tree_sync_from_env(tree, environ):
+    guild_ids = [
+        int(guild_id)
+        for guild_id in environ.get('SYNC_GUILD_IDS', '').split(',')
+        if guild_id.strip()
+    ]
+    return TreeSync(tree,
+                    environ.get('COMMAND_SYNC_FILE', 'command_sync.json'),
+                    guild_ids=guild_ids,
+                    mode=environ.get('COMMAND_SYNC', 'auto').lower())